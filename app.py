@@ -1,17 +1,38 @@
-from flask import Flask, request, jsonify, Response, make_response, send_from_directory
+from flask import Flask, request, jsonify, Response, make_response, send_from_directory, g
+import base64
+import bisect
+import contextlib
+import copy
+import ctypes
+import ctypes.util
+import gzip
+import hmac
+import heapq
 import json
 import os
 import queue
+import re
+import select
+import struct
 import threading
 import time
 import uuid
+import atexit
 import logging
-from collections import deque
-from threading import Lock
+import logging.handlers
+import math
+from collections import deque, defaultdict
+from threading import Lock, RLock
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import zipfile
+import click
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; cross-process locking is skipped there
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 app = Flask(__name__, static_folder='dist', static_url_path='')
@@ -21,11 +42,80 @@ load_dotenv()
 
 # Configure logging based on environment
 is_production = os.getenv('FLASK_ENV') == 'production'
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json' if is_production else 'text')
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', 10))  # Records per second for high-frequency loggers
+
+# Log arguments of these types can't change after the call, so formatting them can wait
+IMMUTABLE_LOG_ARGS = (str, bytes, int, float, bool, type(None))
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler formats in the calling thread; only merge args early when they could still change
+    def prepare(self, record):
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(arg, IMMUTABLE_LOG_ARGS) for arg in args)):
+            record = copy.copy(record)
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+class RateLimitFilter(logging.Filter):
+    # Passes at most `rate` records per second; the next record let through reports how many were dropped
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.window = 0
+        self.passed = 0
+        self.suppressed = 0
+        self.lock = Lock()
+
+    def filter(self, record):
+        now = int(time.monotonic())
+        with self.lock:
+            if now != self.window:
+                self.window, self.passed = now, 0
+            if self.passed >= self.rate:
+                self.suppressed += 1
+                return False
+            self.passed += 1
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            record.msg = f'{record.msg} (+{suppressed} suppressed)'
+        return True
+
+# Handlers only enqueue; a background listener does the formatting and I/O
+log_queue = queue.Queue(-1)
+log_output = logging.StreamHandler()
+if LOG_FORMAT == 'json':
+    log_output.setFormatter(JsonFormatter())
+else:
+    log_output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_output, respect_handler_level=True)
 logging.basicConfig(
     level=logging.INFO if is_production else logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    handlers=[DeferredQueueHandler(log_queue)],
+    force=True
 )
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger(__name__)
+# Loggers for per-request and per-broadcast events, rate limited so bursts don't flood the output
+polling_logger = logging.getLogger('polling')
+broadcast_logger = logging.getLogger('broadcast')
+for noisy_logger in (polling_logger, broadcast_logger):
+    noisy_logger.addFilter(RateLimitFilter(LOG_RATE_LIMIT))
 
 # Reduce logging noise in production
 if is_production:
@@ -37,10 +127,50 @@ if is_production:
 # Get Giphy API key from environment
 GIPHY_API_KEY = os.getenv('GIPHY_API_KEY')
 
+# Upstream services (overridable so benchmarks can point at local stubs)
+NOMINATIM_URL = os.getenv('NOMINATIM_URL', 'https://nominatim.openstreetmap.org')
+GIPHY_API_URL = os.getenv('GIPHY_API_URL', 'https://api.giphy.com')
+GEOCODE_MIN_INTERVAL = 1.0  # Nominatim allows at most one request per second from the whole app
+UNKNOWN_LOCATION = "Unknown location"
+
+# Admin endpoints are disabled unless this bearer token is set
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
 # Directory to store individual pin files
-PINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pins')
+PINS_DIR = os.getenv('PINS_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pins')
 os.makedirs(PINS_DIR, exist_ok=True)
-logger.info(f"Using pins directory: {PINS_DIR}")
+logger.info("Using pins directory: %s", PINS_DIR)
+
+# Geocoding slots are claimed through this file so every process on the host (server workers,
+# the backfill CLI) shares one request rate
+GEOCODE_SLOT_FILE = os.getenv('GEOCODE_SLOT_FILE') or os.path.join(PINS_DIR, '.geocode-slot')
+
+# Additional team maps live in MAPS_DIR/<map_id>; the default map keeps using PINS_DIR
+MAPS_DIR = os.getenv('MAPS_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'maps')
+DEFAULT_MAP_ID = 'default'
+MAP_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')  # Always used with fullmatch
+MAP_IDLE_SECONDS = int(os.getenv('MAP_IDLE_SECONDS', 600))  # Idle maps are dropped from memory after this
+
+# Each pin directory gets a compact snapshot of its pins so startup doesn't parse every file
+SNAPSHOT_FILENAME = '.snapshot'
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_INTERVAL = int(os.getenv('SNAPSHOT_INTERVAL', 60))  # Seconds between snapshot writes
+
+# Picks up pin files edited outside the app: 'auto' (inotify, else scanning), 'inotify', 'scan' or 'off'
+WATCH_MODE = os.getenv('WATCH_MODE', 'auto')
+WATCH_INTERVAL = float(os.getenv('WATCH_INTERVAL', 2))  # Seconds between scans when inotify is unavailable
+
+# Old pins move out of the hot set into compressed segments under <pins dir>/archive
+ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', 0))  # 0 disables age-based archiving
+ARCHIVE_KEEP_NEWEST = int(os.getenv('ARCHIVE_KEEP_NEWEST', 0))  # 0 disables count-based archiving
+ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', 3600))  # Seconds between archive runs
+ARCHIVE_SEGMENT_SIZE = 5000  # Pins per segment file
+
+# Location backfill: one lookup per GeoIndex cell (~5 km at level 12), saved in batches
+BACKFILL_PROGRESS_FILENAME = '.backfill'
+BACKFILL_CELL_LEVEL = 12
+BACKFILL_BATCH_SIZE = 100
+BACKFILL_WORKERS = 4
 
 # Cache for reverse geocoding and pins
 location_cache = {}
@@ -48,26 +178,194 @@ pins_cache = {}  # In-memory cache for pins
 last_cache_update = 0
 CACHE_DURATION = 60  # Seconds before refreshing cache
 
+# Latency buckets (seconds) shared by all histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=''):
+        lines = []
+        cumulative = 0
+        sep = ',' if labels else ''
+        suffix = f'{{{labels}}}' if labels else ''
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{suffix} {self.sum}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+# In-process metrics exposed in Prometheus text format on /metrics
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = defaultdict(int)  # (method, route, status) -> count
+        self.latency = {}  # (method, route) -> Histogram
+        self.counters = defaultdict(int)
+        self.geocode_latency = Histogram()
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe_request(self, method, route, status, seconds):
+        with self.lock:
+            self.requests[(method, route, status)] += 1
+            histogram = self.latency.get((method, route))
+            if histogram is None:
+                histogram = self.latency[(method, route)] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_geocode(self, seconds):
+        with self.lock:
+            self.geocode_latency.observe(seconds)
+
+    def render(self, gauges):
+        lines = []
+        with self.lock:
+            lines.append('# TYPE team_map_http_requests_total counter')
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(
+                    f'team_map_http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}'
+                )
+            lines.append('# TYPE team_map_http_request_duration_seconds histogram')
+            for (method, route), histogram in sorted(self.latency.items()):
+                lines.extend(histogram.render(
+                    'team_map_http_request_duration_seconds',
+                    f'method="{method}",route="{route}"'
+                ))
+            lines.append('# TYPE team_map_geocode_upstream_duration_seconds histogram')
+            lines.extend(self.geocode_latency.render('team_map_geocode_upstream_duration_seconds'))
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE team_map_{name} counter')
+                lines.append(f'team_map_{name} {value}')
+
+        hits = self.counters.get('geocode_cache_hits_total', 0)
+        lookups = hits + self.counters.get('geocode_cache_misses_total', 0)
+        gauges = dict(gauges, geocode_cache_hit_ratio=hits / lookups if lookups else 0.0)
+        for name, value in gauges.items():
+            if isinstance(value, list):
+                # Labelled gauge given as [(labels, value), ...]
+                lines.append(f'# TYPE team_map_{name} gauge')
+                for labels, labelled_value in value:
+                    lines.append(f'team_map_{name}{{{labels}}} {labelled_value}')
+            else:
+                lines.append(f'# TYPE team_map_{name} gauge')
+                lines.append(f'team_map_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def read_pin_file(path):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    metrics.inc('disk_reads_total')
+    return data
+
+def write_pin_file(path, data):
+    # Other processes read this directory, so never let them see a half-written file
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+    metrics.inc('disk_writes_total')
+
+def read_pin(path, pin_id):
+    pin_data = read_pin_file(path)
+    if not isinstance(pin_data, dict):
+        raise ValueError('pin file does not hold an object')
+    # Add the pin ID to the data
+    pin_data['id'] = pin_id
+    return pin_data
+
+# Spaces out upstream calls to one per interval across threads and, via an flock-guarded
+# file holding the next free slot, across processes
+class RateLimiter:
+    MAX_AHEAD = 3600  # Slots further out than this mean the wall clock stepped back
+
+    def __init__(self, interval, path):
+        self.interval = interval
+        self.path = path
+        self.lock = Lock()
+        self.next_allowed = 0.0  # Used when the slot file can't be shared
+
+    def _claim_shared(self, now):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                next_allowed = float(f.read() or 0)
+            except ValueError:
+                next_allowed = 0.0
+            if next_allowed - now > self.MAX_AHEAD:
+                next_allowed = 0.0
+            slot = max(now, next_allowed)
+            f.seek(0)
+            f.truncate()
+            f.write(repr(slot + self.interval))
+            f.flush()
+        return slot
+
+    def wait(self):
+        with self.lock:
+            # Wall clock, since slots are compared between processes
+            now = time.time()
+            slot = None
+            if fcntl is not None:
+                try:
+                    slot = self._claim_shared(now)
+                except OSError as e:
+                    logger.warning("Geocoding rate limit not shared between processes: %s", e)
+            if slot is None:
+                slot = max(now, self.next_allowed)
+                self.next_allowed = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+geocode_limiter = RateLimiter(GEOCODE_MIN_INTERVAL, GEOCODE_SLOT_FILE)
+
 def get_nearest_city(lat, lon):
     # Check cache first
     cache_key = f"{lat},{lon}"
     if cache_key in location_cache:
+        metrics.inc('geocode_cache_hits_total')
         return location_cache[cache_key]
+    metrics.inc('geocode_cache_misses_total')
     
-    # Add a small delay to respect Nominatim's usage policy
-    time.sleep(1)
+    # Respect Nominatim's usage policy across all threads
+    geocode_limiter.wait()
     
     try:
         # Using Nominatim for reverse geocoding
-        url = f"https://nominatim.openstreetmap.org/reverse?lat={lat}&lon={lon}&format=json&zoom=10"
+        url = f"{NOMINATIM_URL}/reverse?lat={lat}&lon={lon}&format=json&zoom=10"
         headers = {
             'User-Agent': 'TUI Map Application/1.0'
         }
-        logger.info(f"Geocoding request for {lat}, {lon}")
-        response = requests.get(url, headers=headers, timeout=5)
+        logger.info("Geocoding request for %s, %s", lat, lon)
+        started = time.perf_counter()
+        try:
+            response = requests.get(url, headers=headers, timeout=5)
+        finally:
+            metrics.observe_geocode(time.perf_counter() - started)
         response.raise_for_status()  # Raise exception for bad status codes
         data = response.json()
-        logger.info(f"Geocoding response: {data}")
+        logger.debug("Geocoding response: %s", data)
         
         # Extract city or nearest named place
         location = None
@@ -77,42 +375,47 @@ def get_nearest_city(lat, lon):
         for key in ['city', 'town', 'village', 'suburb', 'county', 'state']:
             if key in address:
                 location = address[key]
-                logger.info(f"Found location {location} using key {key}")
+                logger.info("Found location %s using key %s", location, key)
                 break
         
         if not location and 'display_name' in data:
             # Fallback to first part of display name
             location = data['display_name'].split(',')[0]
-            logger.info(f"Using fallback location: {location}")
+            logger.info("Using fallback location: %s", location)
         
         # Cache the result
-        location = location or "Unknown location"
+        location = location or UNKNOWN_LOCATION
         location_cache[cache_key] = location
         return location
         
     except Exception as e:
-        logger.error(f"Error in reverse geocoding: {e}")
-        return "Unknown location"
+        logger.error("Error in reverse geocoding: %s", e)
+        return UNKNOWN_LOCATION
+
+def needs_location(pin):
+    return not pin.get('location') or pin['location'] == UNKNOWN_LOCATION
 
 # Broadcast system for SSE
 class Broadcaster:
     def __init__(self):
-        self.clients = set()
+        self.clients = {}  # queue -> client id
         self.messages = deque(maxlen=100)  # Keep last 100 messages
         self.lock = Lock()
     
-    def register(self, queue):
+    def register(self, queue, client_id=None):
         with self.lock:
-            self.clients.add(queue)
+            self.clients[queue] = client_id
             # Send recent messages to new client
             for msg in self.messages:
                 queue.put(msg)
-        logger.info(f"Client registered. Total clients: {len(self.clients)}")
+            total = len(self.clients)
+        broadcast_logger.info("Client registered. Total clients: %d", total)
     
     def unregister(self, queue):
         with self.lock:
-            self.clients.remove(queue)
-        logger.info(f"Client unregistered. Total clients: {len(self.clients)}")
+            self.clients.pop(queue, None)
+            total = len(self.clients)
+        broadcast_logger.info("Client unregistered. Total clients: %d", total)
     
     def broadcast(self, msg):
         with self.lock:
@@ -125,63 +428,1254 @@ class Broadcaster:
                     dead_clients.add(client_queue)
             # Clean up dead clients
             for dead in dead_clients:
-                self.clients.remove(dead)
-        logger.info(f"Broadcasted message to {len(self.clients)} clients")
+                self.clients.pop(dead, None)
+            total = len(self.clients)
+        broadcast_logger.info("Broadcasted message to %d clients", total)
+
+    def queue_depths(self):
+        with self.lock:
+            return [(client_id, client_queue.qsize()) for client_queue, client_id in self.clients.items()]
+
+# Request coalescing for expensive read builders
+class SingleFlight:
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}  # key -> in-flight call state
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            # Someone is already computing this; wait and share their result
+            call['done'].wait()
+            metrics.inc('singleflight_shared_total')
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+
+
+# Keyset index over (timestamp, id), oldest first
+class TimestampIndex:
+    def __init__(self):
+        self.keys = []
+
+    @staticmethod
+    def key(pin):
+        # Hand-edited files may hold other types; keys must stay comparable
+        timestamp = pin.get('timestamp')
+        return (timestamp if isinstance(timestamp, str) else '', pin['id'])
+
+    def add(self, pin):
+        bisect.insort(self.keys, self.key(pin))
+
+    def remove(self, pin):
+        key = self.key(pin)
+        position = bisect.bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            del self.keys[position]
+
+    def newest(self, limit, before=None):
+        # Keys strictly older than `before`, newest first
+        end = len(self.keys) if before is None else bisect.bisect_left(self.keys, before)
+        return [pin_id for _, pin_id in reversed(self.keys[max(0, end - limit):end])]
+
+# Inverted index over name and location tokens for prefix search
+class SearchIndex:
+    FIELD_WEIGHTS = {'name': 2, 'location': 1}
+
+    def __init__(self):
+        self.postings = {}  # token -> {pin id: field weight}
+        self.tokens = []  # Sorted tokens for prefix range lookups
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r'\w+', text.lower()) if isinstance(text, str) else []
+
+    def _pin_tokens(self, pin):
+        weights = {}
+        for field, weight in self.FIELD_WEIGHTS.items():
+            for token in self.tokenize(pin.get(field)):
+                weights[token] = max(weights.get(token, 0), weight)
+        return weights
+
+    def add(self, pin):
+        for token, weight in self._pin_tokens(pin).items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = {}
+                bisect.insort(self.tokens, token)
+            posting[pin['id']] = weight
+
+    def remove(self, pin):
+        for token in self._pin_tokens(pin):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(pin['id'], None)
+            if not posting:
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+
+    def search(self, query):
+        # Every query token must prefix-match some pin token; exact and name matches rank higher
+        scores = None
+        for query_token in set(self.tokenize(query)):
+            token_scores = {}
+            start = bisect.bisect_left(self.tokens, query_token)
+            for token in self.tokens[start:bisect.bisect_left(self.tokens, query_token + '\uffff', start)]:
+                boost = 2 if token == query_token else 1
+                for pin_id, weight in self.postings[token].items():
+                    token_scores[pin_id] = max(token_scores.get(pin_id, 0), weight * boost)
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {pin_id: scores[pin_id] + score for pin_id, score in token_scores.items() if pin_id in scores}
+            if not scores:
+                return {}
+        return scores or {}
+
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_many(lat, lng, points):
+    # Distances in km from (lat, lng) to many (lat_rad, lng_rad, cos_lat) points in one pass
+    phi1 = math.radians(lat)
+    lam1 = math.radians(lng)
+    cos1 = math.cos(phi1)
+    sin, sqrt = math.sin, math.sqrt
+    return [
+        2 * EARTH_RADIUS_KM * math.asin(min(1.0, sqrt(sin((phi2 - phi1) / 2) ** 2 + cos1 * cos2 * sin((lam2 - lam1) / 2) ** 2)))
+        for phi2, lam2, cos2 in points
+    ]
 
-broadcaster = Broadcaster()
+# Multi-level lat/lng grid: level l splits the globe into 2^l x 2^(l+1) cells of 180/2^l degrees
+class GeoIndex:
+    LEVELS = 15  # Leaf cells are ~0.011 degrees (~1.2 km)
 
-def load_locations():
-    pins = []
+    def __init__(self):
+        self.counts = [defaultdict(int) for _ in range(self.LEVELS)]  # level -> cell -> pins
+        self.leaves = {}  # leaf cell -> {pin id: (lat_rad, lng_rad, cos_lat)}
+
+    @staticmethod
+    def coordinates(pin):
+        try:
+            lat, lng = float(pin['lat']), float(pin['lng'])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if not (math.isfinite(lat) and math.isfinite(lng)):
+            return None
+        # Leaflet allows wrapped longitudes, so normalize before bucketing
+        return max(-90.0, min(90.0, lat)), (lng + 180.0) % 360.0 - 180.0
+
+    @staticmethod
+    def cell(level, lat, lng):
+        size = 180.0 / (1 << level)
+        return (min(int((lat + 90.0) / size), (1 << level) - 1),
+                min(int((lng + 180.0) / size), (2 << level) - 1))
+
+    @staticmethod
+    def cell_bounds(level, i, j):
+        size = 180.0 / (1 << level)
+        return i * size - 90.0, j * size - 180.0, (i + 1) * size - 90.0, (j + 1) * size - 180.0
+
+    def add(self, pin):
+        coordinates = self.coordinates(pin)
+        if coordinates is None:
+            return
+        lat, lng = coordinates
+        for level in range(self.LEVELS):
+            self.counts[level][self.cell(level, lat, lng)] += 1
+        phi = math.radians(lat)
+        leaf = self.leaves.setdefault(self.cell(self.LEVELS - 1, lat, lng), {})
+        leaf[pin['id']] = (phi, math.radians(lng), math.cos(phi))
+
+    def remove(self, pin):
+        coordinates = self.coordinates(pin)
+        if coordinates is None:
+            return
+        lat, lng = coordinates
+        for level in range(self.LEVELS):
+            cell = self.cell(level, lat, lng)
+            self.counts[level][cell] -= 1
+            if self.counts[level][cell] <= 0:
+                del self.counts[level][cell]
+        leaf_cell = self.cell(self.LEVELS - 1, lat, lng)
+        leaf = self.leaves.get(leaf_cell, {})
+        leaf.pop(pin['id'], None)
+        if not leaf:
+            self.leaves.pop(leaf_cell, None)
+
+    def _min_distance(self, phi1, lam1, cos1, level, i, j):
+        # Lower bound on the distance from the query to any point in the cell
+        lat_lo, lng_lo, lat_hi, lng_hi = (math.radians(v) for v in self.cell_bounds(level, i, j))
+        dphi = 0.0 if lat_lo <= phi1 <= lat_hi else min(abs(phi1 - lat_lo), abs(phi1 - lat_hi))
+        if lng_lo <= lam1 <= lng_hi:
+            dlam = 0.0
+        else:
+            dlam = min((lng_lo - lam1) % (2 * math.pi), (lam1 - lng_hi) % (2 * math.pi))
+        cos_far = math.cos(max(abs(lat_lo), abs(lat_hi)))
+        h = math.sin(dphi / 2) ** 2 + cos1 * max(cos_far, 0.0) * math.sin(dlam / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+    def nearest(self, lat, lng, k, radius_km=None):
+        # Best-first descent: cells are expanded in order of their distance lower bound,
+        # so a pin popped off the heap is closer than anything still unexplored
+        lat, lng = self.coordinates({'lat': lat, 'lng': lng})
+        phi1, lam1 = math.radians(lat), math.radians(lng)
+        cos1 = math.cos(phi1)
+        heap = []
+        seq = 0
+        for cell in self.counts[0]:
+            heap.append((self._min_distance(phi1, lam1, cos1, 0, *cell), seq, 0, cell))
+            seq += 1
+        heapq.heapify(heap)
+
+        results = []
+        while heap and len(results) < k:
+            distance, _, level, item = heapq.heappop(heap)
+            if radius_km is not None and distance > radius_km:
+                break
+            if level is None:
+                results.append((item, distance))
+            elif level == self.LEVELS - 1:
+                leaf = self.leaves.get(item, {})
+                for pin_id, pin_distance in zip(leaf, haversine_many(lat, lng, leaf.values())):
+                    heapq.heappush(heap, (pin_distance, seq, None, pin_id))
+                    seq += 1
+            else:
+                i, j = item
+                for child in ((2 * i, 2 * j), (2 * i, 2 * j + 1), (2 * i + 1, 2 * j), (2 * i + 1, 2 * j + 1)):
+                    if child in self.counts[level + 1]:
+                        heapq.heappush(heap, (self._min_distance(phi1, lam1, cos1, level + 1, *child), seq, level + 1, child))
+                        seq += 1
+        return results
+
+    def cells_in(self, level, south, west, north, east):
+        # Non-empty cells intersecting the box; walks whichever is smaller, the box or the level
+        counts = self.counts[level]
+        i_lo, j_lo = self.cell(level, south, west)
+        i_hi, j_hi = self.cell(level, north, east)
+        if (i_hi - i_lo + 1) * (j_hi - j_lo + 1) <= len(counts):
+            return [
+                ((i, j), counts[(i, j)])
+                for i in range(i_lo, i_hi + 1)
+                for j in range(j_lo, j_hi + 1)
+                if (i, j) in counts
+            ]
+        return [
+            ((i, j), count) for (i, j), count in counts.items()
+            if i_lo <= i <= i_hi and j_lo <= j <= j_hi
+        ]
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
     try:
-        for filename in os.listdir(PINS_DIR):
-            if filename.endswith('.json'):
-                with open(os.path.join(PINS_DIR, filename), 'r') as f:
-                    pin_data = json.load(f)
-                    # Add the pin ID to the data
-                    pin_data['id'] = filename.replace('.json', '')
-                    pins.append(pin_data)
-        
-        # Sort pins by timestamp if available
-        pins.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        return {'status': 'success', 'pins': pins}
+        timestamp, pin_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return (str(timestamp), str(pin_id))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+# Cold tier: write-once gzip JSON-lines segments plus a small id -> (segment, timestamp) index.
+# Several processes may share a pin directory, so index updates happen under archive/.lock
+# and always start from the index on disk.
+class PinArchive:
+    INDEX_FILENAME = 'index.json'
+    LOCK_FILENAME = '.lock'
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.segments = []
+        self.locations = {}  # pin id -> segment name
+        self.keys = []  # Sorted (timestamp, id) of archived pins
+        self.deleted = set()  # Tombstones: ids deleted after archiving; segments are never rewritten
+        self.index_stat = None  # Identity of the index file this state was read from
+        self.cached_segment = (None, {})  # Last decompressed segment
+
+    def _index_path(self):
+        return os.path.join(self.archive_dir, self.INDEX_FILENAME)
+
+    @staticmethod
+    def _file_identity(stat):
+        # The index is always replaced, never rewritten, so a new inode means new contents
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with open(os.path.join(self.archive_dir, self.LOCK_FILENAME), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield  # Released when the file is closed
+
+    def load(self):
+        self.segments, self.locations, self.keys = [], {}, []
+        self.deleted = set()
+        self.index_stat = None
+        try:
+            with open(self._index_path(), 'r') as f:
+                stat = os.fstat(f.fileno())
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        self.index_stat = self._file_identity(stat)
+        self.segments = index['segments']
+        self.deleted = set(index.get('deleted', []))
+        for pin_id, (segment, timestamp) in index['pins'].items():
+            self.locations[pin_id] = segment
+            self.keys.append((timestamp, pin_id))
+        self.keys.sort()
+
+    def refresh(self):
+        # Picks up pins archived by other processes since the index was last read
+        try:
+            current = self._file_identity(os.stat(self._index_path()))
+        except FileNotFoundError:
+            current = None
+        if current != self.index_stat:
+            self.load()
+
+    def count(self):
+        return len(self.locations)
+
+    def newest(self, limit, before=None):
+        end = len(self.keys) if before is None else bisect.bisect_left(self.keys, before)
+        return list(reversed(self.keys[max(0, end - limit):end]))
+
+    def _read_segment(self, segment):
+        if self.cached_segment[0] != segment:
+            pins = {}
+            with gzip.open(os.path.join(self.archive_dir, segment), 'rt') as f:
+                for line in f:
+                    pin = json.loads(line)
+                    pins[pin['id']] = pin
+            metrics.inc('disk_reads_total')
+            self.cached_segment = (segment, pins)
+        return self.cached_segment[1]
+
+    def get(self, pin_id):
+        segment = self.locations.get(pin_id)
+        return self._read_segment(segment).get(pin_id) if segment else None
+
+    def get_many(self, pin_ids):
+        # Grouped by segment so each segment is decompressed at most once
+        by_segment = defaultdict(list)
+        for pin_id in pin_ids:
+            by_segment[self.locations[pin_id]].append(pin_id)
+        found = {}
+        for segment, segment_pin_ids in by_segment.items():
+            pins = self._read_segment(segment)
+            for pin_id in segment_pin_ids:
+                found[pin_id] = pins[pin_id]
+        return [found[pin_id] for pin_id in pin_ids]
+
+    def append(self, pins):
+        # Returns the pins actually archived; any another process archived first are skipped
+        with self._exclusive():
+            self.load()
+            pins = [pin for pin in pins if pin['id'] not in self.locations]
+            for start in range(0, len(pins), ARCHIVE_SEGMENT_SIZE):
+                batch = pins[start:start + ARCHIVE_SEGMENT_SIZE]
+                # Unique across processes, and sorts by creation time
+                segment = f'segment-{time.time_ns()}-{os.getpid()}.jsonl.gz'
+                temp_path = os.path.join(self.archive_dir, f'{segment}.tmp')
+                with gzip.open(temp_path, 'wt') as f:
+                    for pin in batch:
+                        f.write(json.dumps(pin, separators=(',', ':')) + '\n')
+                os.replace(temp_path, os.path.join(self.archive_dir, segment))
+                metrics.inc('disk_writes_total')
+                self.segments.append(segment)
+                for pin in batch:
+                    self.locations[pin['id']] = segment
+                    bisect.insort(self.keys, TimestampIndex.key(pin))
+            if pins:
+                self.deleted.difference_update(pin['id'] for pin in pins)
+                self._write_index()
+        return pins
+
+    def delete(self, pin_id):
+        with self._exclusive():
+            self.load()
+            if pin_id not in self.locations:
+                return False
+            self.locations.pop(pin_id)
+            self.keys = [key for key in self.keys if key[1] != pin_id]
+            self.deleted.add(pin_id)
+            self._write_index()
+        return True
+
+    def files(self):
+        # Index plus every segment it references, e.g. for backups
+        names = [self.INDEX_FILENAME] if self.index_stat is not None else []
+        return names + self.segments
+
+    def _write_index(self):
+        timestamps = {pin_id: timestamp for timestamp, pin_id in self.keys}
+        index = {
+            'formatVersion': 1,
+            'segments': self.segments,
+            'pins': {pin_id: [segment, timestamps[pin_id]] for pin_id, segment in self.locations.items()},
+            'deleted': sorted(self.deleted)
+        }
+        temp_path = os.path.join(self.archive_dir, f'{self.INDEX_FILENAME}.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(temp_path, self._index_path())
+        self.index_stat = self._file_identity(os.stat(self._index_path()))
+        metrics.inc('disk_writes_total')
+
+# In-memory view of PINS_DIR; all pin reads and writes go through here
+class PinStore:
+    def __init__(self, pins_dir):
+        self.pins_dir = pins_dir
+        self.lock = RLock()
+        self.pins = None  # id -> pin, loaded on first use
+        self.file_stats = {}  # id -> (mtime_ns, size) of the pin file backing each pin
+        self.version = 0  # Bumped on every write so coalesced reads never see stale results
+        self.snapshot_version = None  # Store version last written to the snapshot
+        self.connections_count = 0  # Updated whenever the connections listing is built
+        self.by_time = TimestampIndex()
+        self.by_text = SearchIndex()
+        self.by_location = GeoIndex()
+        self.indexes = [self.by_time, self.by_text, self.by_location]  # Kept in sync on every add/remove
+        self.archive = PinArchive(os.path.join(pins_dir, 'archive'))
+
+    def path(self, pin_id):
+        return os.path.join(self.pins_dir, f'{pin_id}.json')
+
+    def load(self):
+        with self.lock:
+            if self.pins is not None:
+                return
+            started = time.perf_counter()
+            self.archive.load()
+            snapshot_pins, snapshot_stats = self._read_snapshot()
+
+            # Built aside and swapped in at the end, so a failure never leaves a partial store behind
+            pins, file_stats = {}, {}
+            by_time, by_text, by_location = TimestampIndex(), SearchIndex(), GeoIndex()
+            indexes = [by_time, by_text, by_location]
+
+            # Only files added or changed since the snapshot are parsed; the rest come from it
+            replayed = skipped = 0
+            entries = list(os.scandir(self.pins_dir)) if os.path.isdir(self.pins_dir) else []
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                pin_id = entry.name[:-len('.json')]
+                try:
+                    stat = entry.stat()
+                    file_stat = (stat.st_mtime_ns, stat.st_size)
+                    pin_data = snapshot_pins.get(pin_id) if snapshot_stats.get(pin_id) == file_stat else None
+                    if pin_data is None:
+                        pin_data = read_pin(entry.path, pin_id)
+                        replayed += 1
+                except (OSError, ValueError) as e:
+                    # Removed mid-scan (e.g. archived by another process) or unreadable; the watcher retries changes
+                    logger.warning("Skipping pin file %s: %s", entry.path, e)
+                    skipped += 1
+                    continue
+                file_stats[pin_id] = file_stat
+                pins[pin_id] = pin_data
+                for index in indexes:
+                    index.add(pin_data)
+
+            self.pins, self.file_stats = pins, file_stats
+            self.by_time, self.by_text, self.by_location = by_time, by_text, by_location
+            self.indexes = indexes
+            if replayed == 0 and skipped == 0 and len(self.pins) == len(snapshot_pins):
+                self.snapshot_version = self.version
+            logger.info("Loaded %d pins in %.2fs (%d from snapshot, %d from files, %d skipped)",
+                        len(self.pins), time.perf_counter() - started, len(self.pins) - replayed, replayed, skipped)
+
+    def _snapshot_path(self):
+        return os.path.join(self.pins_dir, SNAPSHOT_FILENAME)
+
+    def _read_snapshot(self):
+        try:
+            with open(self._snapshot_path(), 'rb') as f:
+                snapshot = json.loads(f.read())
+            metrics.inc('disk_reads_total')
+        except FileNotFoundError:
+            return {}, {}
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable snapshot in %s: %s", self.pins_dir, e)
+            return {}, {}
+        if snapshot.get('formatVersion') != SNAPSHOT_FORMAT_VERSION:
+            logger.warning("Ignoring snapshot with format version %s in %s", snapshot.get('formatVersion'), self.pins_dir)
+            return {}, {}
+        return snapshot['pins'], {pin_id: tuple(stat) for pin_id, stat in snapshot['files'].items()}
+
+    def write_snapshot(self):
+        # Pins are never mutated in place, so a shallow copy under the lock is a consistent view
+        with self.lock:
+            if self.pins is None or self.snapshot_version == self.version:
+                return False
+            version = self.version
+            pins = dict(self.pins)
+            file_stats = dict(self.file_stats)
+
+        data = json.dumps({
+            'formatVersion': SNAPSHOT_FORMAT_VERSION,
+            'created': datetime.now().isoformat(),
+            'pins': pins,
+            'files': file_stats
+        }, separators=(',', ':'))
+        os.makedirs(self.pins_dir, exist_ok=True)
+        temp_path = f'{self._snapshot_path()}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(data)
+        os.replace(temp_path, self._snapshot_path())
+        metrics.inc('disk_writes_total')
+
+        with self.lock:
+            self.snapshot_version = version
+        logger.info("Wrote snapshot of %d pins to %s", len(pins), self.pins_dir)
+        return True
+
+    def _index(self, pin):
+        self.pins[pin['id']] = pin
+        for index in self.indexes:
+            index.add(pin)
+
+    def _unindex(self, pin_id):
+        pin = self.pins.pop(pin_id, None)
+        if pin is not None:
+            for index in self.indexes:
+                index.remove(pin)
+        return pin
+
+    def count(self):
+        with self.lock:
+            self.load()
+            return len(self.pins)
+
+    def get(self, pin_id):
+        # Returns a copy so callers can modify it before saving
+        with self.lock:
+            self.load()
+            pin = self.pins.get(pin_id)
+            return copy.deepcopy(pin) if pin is not None else None
+
+    def get_any(self, pin_id):
+        # Looks in the hot set first, then the archive; returns (pin, archived)
+        with self.lock:
+            self.load()
+            if pin_id in self.pins:
+                return self.pins[pin_id], False
+            self.archive.refresh()
+            pin = self.archive.get(pin_id)
+            return pin, pin is not None
+
+    def all(self, include_archived=False):
+        # Stored pins are replaced rather than mutated, so these are safe to serialize
+        with self.lock:
+            self.load()
+            pins = [self.pins[pin_id] for pin_id in self.by_time.newest(len(self.pins))]
+            if include_archived:
+                pins, _ = self.page(len(pins) + self.archive.count(), include_archived=True)
+            return pins
+
+    def page(self, limit, cursor=None, include_archived=False):
+        with self.lock:
+            self.load()
+            before = decode_cursor(cursor) if cursor else None
+            keys = [TimestampIndex.key(self.pins[pin_id]) for pin_id in self.by_time.newest(limit, before)]
+            if include_archived:
+                self.archive.refresh()
+                # Merge the newest keys of both tiers; a pin caught mid-archive counts as hot
+                archived = [key for key in self.archive.newest(limit, before) if key[1] not in self.pins]
+                keys = heapq.nlargest(limit, keys + archived)
+            archived_ids = [pin_id for _, pin_id in keys if pin_id not in self.pins]
+            archived_pins = dict(zip(archived_ids, self.archive.get_many(archived_ids)))
+            pins = [self.pins[pin_id] if pin_id in self.pins else archived_pins[pin_id] for _, pin_id in keys]
+
+            oldest = [self.by_time.keys[0]] if self.by_time.keys else []
+            if include_archived and self.archive.keys:
+                oldest.append(self.archive.keys[0])
+            more = bool(keys) and min(oldest) < keys[-1]
+            next_cursor = encode_cursor(keys[-1]) if more else None
+            return pins, next_cursor
+
+    def archive_old(self, max_age_days=0, keep_newest=0):
+        # Moves the oldest pins beyond either limit into a new archive segment
+        with self.lock:
+            self.load()
+            cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat() if max_age_days else None
+            candidates = []
+            for timestamp, pin_id in self.by_time.keys:
+                over_count = keep_newest and len(self.pins) - len(candidates) > keep_newest
+                too_old = cutoff is not None and timestamp < cutoff
+                if not (over_count or too_old):
+                    break
+                candidates.append(self.pins[pin_id])
+            if not candidates:
+                return 0
+
+            # Segment and index are durable before any pin file is removed
+            archived = self.archive.append(candidates)
+            for pin in archived:
+                try:
+                    os.remove(self.path(pin['id']))
+                except FileNotFoundError:
+                    pass  # Already removed by another process or an operator
+                self.file_stats.pop(pin['id'], None)
+                self._unindex(pin['id'])
+            if archived:
+                self.version += 1
+                logger.info("Archived %d pins from %s", len(archived), self.pins_dir)
+            return len(archived)
+
+    def search(self, query, limit):
+        with self.lock:
+            self.load()
+            scores = self.by_text.search(query)
+            # Best score first, newest first among equal scores
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], TimestampIndex.key(self.pins[item[0]])))
+            return [self.pins[pin_id] for pin_id, _ in best]
+
+    def nearby(self, lat, lng, k, radius_km=None):
+        with self.lock:
+            self.load()
+            return [
+                dict(self.pins[pin_id], distanceKm=round(distance, 3))
+                for pin_id, distance in self.by_location.nearest(lat, lng, k, radius_km)
+            ]
+
+    def heatmap(self, level, boxes):
+        with self.lock:
+            self.load()
+            cells = []
+            for box in boxes:
+                for (i, j), count in self.by_location.cells_in(level, *box):
+                    south, west, north, east = GeoIndex.cell_bounds(level, i, j)
+                    cells.append({'south': south, 'west': west, 'north': north, 'east': east, 'count': count})
+            return cells
+
+    def save(self, pin):
+        # Index updates can't raise (malformed fields are indexed as empty), so once the
+        # file is written the in-memory state always follows it
+        with self.lock:
+            self.load()
+            pin = copy.deepcopy(pin)
+            os.makedirs(self.pins_dir, exist_ok=True)
+            write_pin_file(self.path(pin['id']), pin)
+            stat = os.stat(self.path(pin['id']))
+            self.file_stats[pin['id']] = (stat.st_mtime_ns, stat.st_size)
+            self._unindex(pin['id'])
+            self._index(pin)
+            self.version += 1
+
+    def set_locations(self, locations):
+        # Only fills pins that still lack a location, so edits made meanwhile are kept
+        with self.lock:
+            self.load()
+            updated = []
+            for pin_id, location in locations.items():
+                pin = self.pins.get(pin_id)
+                if pin is None or not needs_location(pin):
+                    continue
+                pin = dict(pin, location=location)
+                self.save(pin)
+                updated.append(pin)
+            return updated
+
+    def changed_files(self):
+        # Stat-only comparison against the loaded state; nothing is parsed here
+        with self.lock:
+            if self.pins is None:
+                return []
+            known = dict(self.file_stats)
+        changed = []
+        seen = set()
+        entries = list(os.scandir(self.pins_dir)) if os.path.isdir(self.pins_dir) else []
+        for entry in entries:
+            if not entry.name.endswith('.json'):
+                continue
+            pin_id = entry.name[:-len('.json')]
+            seen.add(pin_id)
+            stat = entry.stat()
+            if known.get(pin_id) != (stat.st_mtime_ns, stat.st_size):
+                changed.append(pin_id)
+        changed.extend(pin_id for pin_id in known if pin_id not in seen)
+        return changed
+
+    def sync_files(self, pin_ids):
+        # Brings the given pins in line with their files; returns (event type, pin) per real change
+        changes = []
+        with self.lock:
+            if self.pins is None:
+                return changes  # Not loaded yet, so the next load reads the files anyway
+            for pin_id in pin_ids:
+                change = self._sync_file(pin_id)
+                if change is not None:
+                    changes.append(change)
+            if changes:
+                self.version += 1
+        return changes
+
+    def _sync_file(self, pin_id):
+        path = self.path(pin_id)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.file_stats.pop(pin_id, None)
+            pin = self._unindex(pin_id)
+            if pin is None:
+                return None
+            # Another process archived it; the index is written before pin files are removed
+            self.archive.refresh()
+            if pin_id in self.archive.locations:
+                self.version += 1
+                return None
+            return ('pin_deleted', pin)
+        file_stat = (stat.st_mtime_ns, stat.st_size)
+        if self.file_stats.get(pin_id) == file_stat:
+            return None  # Our own write, or already applied
+        try:
+            pin_data = read_pin(path, pin_id)
+        except (OSError, ValueError):
+            return None  # Still being written; the next event or scan picks it up
+        existed = self._unindex(pin_id) is not None
+        self.file_stats[pin_id] = file_stat
+        self._index(pin_data)
+        return ('pin_updated' if existed else 'pin_added', pin_data)
+
+    def delete(self, pin_id):
+        # Removes the pin from both tiers; archived copies are tombstoned in the archive index
+        with self.lock:
+            self.load()
+            self.archive.refresh()
+            hot = pin_id in self.pins
+            if not hot and pin_id not in self.archive.locations:
+                return False
+            if hot:
+                try:
+                    os.remove(self.path(pin_id))
+                except FileNotFoundError:
+                    # Another process archived or removed it; pick up any archive entry it wrote
+                    self.archive.refresh()
+                self.file_stats.pop(pin_id, None)
+                self._unindex(pin_id)
+            if pin_id in self.archive.locations:
+                self.archive.delete(pin_id)
+            self.version += 1
+            return True
+
+    def archive_files(self):
+        # Paths relative to the pins directory, for exports
+        with self.lock:
+            self.load()
+            self.archive.refresh()
+            return [os.path.join('archive', name) for name in self.archive.files()]
+
+# One team's pins, subscribers and in-flight reads; nothing here is shared between maps
+class TeamMap:
+    def __init__(self, map_id, pins_dir):
+        self.map_id = map_id
+        self.store = PinStore(pins_dir)
+        self.broadcaster = Broadcaster()
+        self.single_flight = SingleFlight()
+        self.active_requests = 0
+        self.last_used = time.monotonic()
+
+        self.backfill = None  # Latest LocationBackfill for this map
+
+    def is_idle(self, now):
+        return (self.active_requests == 0 and not self.broadcaster.clients
+                and now - self.last_used > MAP_IDLE_SECONDS)
+
+# Re-geocodes pins saved without a usable location, one lookup per cell of nearby pins.
+# Resolved cells are recorded in <pins dir>/.backfill so an interrupted run picks up where it stopped.
+class LocationBackfill:
+    def __init__(self, team_map, batch_size=BACKFILL_BATCH_SIZE):
+        self.team_map = team_map
+        self.batch_size = batch_size
+        self.lock = Lock()
+        self.state = 'pending'
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.pins_total = 0
+        self.pins_updated = 0
+        self.cells_total = 0
+        self.cells_done = 0
+        self.cells_failed = 0
+        self.cells_resumed = 0
+
+    @staticmethod
+    def cell_key(pin):
+        coordinates = GeoIndex.coordinates(pin)
+        if coordinates is None:
+            return None
+        i, j = GeoIndex.cell(BACKFILL_CELL_LEVEL, *coordinates)
+        return f'{i},{j}'
+
+    @staticmethod
+    def cell_center(key):
+        i, j = (int(part) for part in key.split(','))
+        south, west, north, east = GeoIndex.cell_bounds(BACKFILL_CELL_LEVEL, i, j)
+        return round((south + north) / 2, 5), round((west + east) / 2, 5)
+
+    def _progress_path(self):
+        return os.path.join(self.team_map.store.pins_dir, BACKFILL_PROGRESS_FILENAME)
+
+    def _read_progress(self):
+        try:
+            with open(self._progress_path(), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logger.warning("Ignoring unreadable backfill progress in %s: %s", self.team_map.store.pins_dir, e)
+            return {}
+
+    def _write_progress(self, resolved):
+        temp_path = f'{self._progress_path()}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(resolved, f, separators=(',', ':'))
+        os.replace(temp_path, self._progress_path())
+
+    def _flush(self, pending):
+        updated = self.team_map.store.set_locations(pending)
+        pending.clear()
+        for pin in updated:
+            self.team_map.broadcaster.broadcast(json.dumps({'type': 'pin_updated', 'pin': pin}))
+        with self.lock:
+            self.pins_updated += len(updated)
+        metrics.inc('backfill_pins_updated_total', len(updated))
+
+    def run(self):
+        store = self.team_map.store
+        with self.lock:
+            self.state = 'running'
+            self.started = time.time()
+        try:
+            resolved = self._read_progress()  # cell -> location from an interrupted run
+            cells = defaultdict(list)
+            for pin in store.all():
+                key = self.cell_key(pin) if needs_location(pin) else None
+                if key is not None:
+                    cells[key].append(pin['id'])
+            with self.lock:
+                self.pins_total = sum(len(pin_ids) for pin_ids in cells.values())
+                self.cells_total = len(cells)
+                self.cells_resumed = sum(1 for key in cells if key in resolved)
+            logger.info("Backfilling locations for %d pins in %d cells of map %s",
+                        self.pins_total, self.cells_total, self.team_map.map_id)
+
+            def lookup(key):
+                if key in resolved:
+                    return key, resolved[key]
+                return key, get_nearest_city(*self.cell_center(key))
+
+            # Workers overlap request latency; the shared limiter still caps the request rate
+            pending = {}
+            with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS, thread_name_prefix='backfill') as executor:
+                for key, location in executor.map(lookup, list(cells)):
+                    with self.lock:
+                        self.cells_done += 1
+                        if location == UNKNOWN_LOCATION:
+                            self.cells_failed += 1
+                    if location == UNKNOWN_LOCATION:
+                        continue
+                    if key not in resolved:
+                        resolved[key] = location
+                        self._write_progress(resolved)
+                    pending.update((pin_id, location) for pin_id in cells[key])
+                    if len(pending) >= self.batch_size:
+                        self._flush(pending)
+            self._flush(pending)
+
+            # Finished cleanly, so the next run starts from a fresh scan
+            if os.path.exists(self._progress_path()):
+                os.remove(self._progress_path())
+            with self.lock:
+                self.state = 'finished'
+            logger.info("Location backfill for map %s updated %d pins (%d cells unresolved)",
+                        self.team_map.map_id, self.pins_updated, self.cells_failed)
+        except Exception as e:
+            logger.error("Location backfill failed for map %s: %s", self.team_map.map_id, e, exc_info=True)
+            with self.lock:
+                self.state = 'failed'
+                self.error = str(e)
+        finally:
+            with self.lock:
+                self.finished = time.time()
+
+    def status(self):
+        with self.lock:
+            return {
+                'mapId': self.team_map.map_id,
+                'state': self.state,
+                'error': self.error,
+                'startedAt': datetime.fromtimestamp(self.started).isoformat() if self.started else None,
+                'finishedAt': datetime.fromtimestamp(self.finished).isoformat() if self.finished else None,
+                'pinsTotal': self.pins_total,
+                'pinsUpdated': self.pins_updated,
+                'cellsTotal': self.cells_total,
+                'cellsDone': self.cells_done,
+                'cellsFailed': self.cells_failed,
+                'cellsResumed': self.cells_resumed,
+            }
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# Feeds pin files changed outside the app into the in-memory stores and SSE subscribers
+class DirectoryWatcher:
+    def __init__(self):
+        self.lock = Lock()
+        self.maps = {}  # map id -> TeamMap
+        self.watches = {}  # inotify watch descriptor -> map id
+        self.libc = None
+        self.fd = None
+
+    def watch(self, team_map):
+        with self.lock:
+            self.maps[team_map.map_id] = team_map
+
+    def unwatch(self, team_map):
+        with self.lock:
+            if self.maps.get(team_map.map_id) is not team_map:
+                return  # Reopened since it was evicted; the new map owns the watch now
+            del self.maps[team_map.map_id]
+            for wd, map_id in list(self.watches.items()):
+                if map_id == team_map.map_id:
+                    del self.watches[wd]
+                    self.libc.inotify_rm_watch(self.fd, wd)
+
+    def start(self):
+        if WATCH_MODE == 'off':
+            return
+        if WATCH_MODE in ('auto', 'inotify'):
+            self._init_inotify()
+        target = self._run_inotify if self.fd is not None else self._run_scan
+        logger.info("Watching pin directories using %s", 'inotify' if self.fd is not None else 'scanning')
+        threading.Thread(target=target, name='pin-watcher', daemon=True).start()
+
+    def _init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable, falling back to scanning: %s", e)
+            return
+        if fd < 0:
+            logger.warning("inotify_init1 failed, falling back to scanning: errno %d", ctypes.get_errno())
+            return
+        self.libc, self.fd = libc, fd
+
+    def _apply(self, team_map, pin_ids):
+        changes = team_map.store.sync_files(pin_ids)
+        for event_type, pin in changes:
+            team_map.broadcaster.broadcast(json.dumps({'type': event_type, 'pin': pin}))
+        if changes:
+            metrics.inc('watcher_changes_total', len(changes))
+            logger.info("Applied %d external pin file changes in map %s", len(changes), team_map.map_id)
+
+    def _add_missing_watches(self):
+        # Map directories may not exist until their first pin is saved, so retry each pass
+        added = []
+        with self.lock:
+            watched = set(self.watches.values())
+            pending = [team_map for map_id, team_map in self.maps.items() if map_id not in watched]
+            for team_map in pending:
+                if not os.path.isdir(team_map.store.pins_dir):
+                    continue
+                wd = self.libc.inotify_add_watch(
+                    self.fd, os.fsencode(team_map.store.pins_dir),
+                    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+                )
+                if wd >= 0:
+                    self.watches[wd] = team_map.map_id
+                    added.append(team_map)
+        # Catch anything that changed before the watch was in place. This takes each store's
+        # lock, which a long load can hold, so it must not run under the watcher lock.
+        for team_map in added:
+            self._apply(team_map, team_map.store.changed_files())
+
+    def _run_inotify(self):
+        while True:
+            try:
+                self._add_missing_watches()
+                ready, _, _ = select.select([self.fd], [], [], WATCH_INTERVAL)
+                if not ready:
+                    continue
+                time.sleep(0.05)  # Let bursts (e.g. unzipping an archive) arrive as one batch
+                changed = defaultdict(set)
+                overflow = False
+                try:
+                    while True:
+                        buffer = os.read(self.fd, 64 * 1024)
+                        offset = 0
+                        while offset < len(buffer):
+                            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                            offset += INOTIFY_EVENT.size
+                            name = buffer[offset:offset + name_length].rstrip(b'\0').decode('utf-8', 'replace')
+                            offset += name_length
+                            if mask & IN_Q_OVERFLOW:
+                                overflow = True
+                            elif mask & IN_IGNORED:
+                                with self.lock:
+                                    self.watches.pop(wd, None)
+                            elif name.endswith('.json'):
+                                changed[wd].add(name[:-len('.json')])
+                except BlockingIOError:
+                    pass
+
+                with self.lock:
+                    targets = {wd: self.maps.get(map_id) for wd, map_id in self.watches.items()}
+                for wd, pin_ids in changed.items():
+                    team_map = targets.get(wd)
+                    if team_map is not None:
+                        self._apply(team_map, pin_ids)
+                if overflow:
+                    # Events were dropped, so compare every loaded map against its directory
+                    for team_map in targets.values():
+                        if team_map is not None:
+                            self._apply(team_map, team_map.store.changed_files())
+            except Exception as e:
+                logger.error("Error watching pin directories: %s", e)
+                time.sleep(WATCH_INTERVAL)
+
+    def _run_scan(self):
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            with self.lock:
+                team_maps = list(self.maps.values())
+            for team_map in team_maps:
+                try:
+                    changed = team_map.store.changed_files()
+                    if changed:
+                        self._apply(team_map, changed)
+                except Exception as e:
+                    logger.error("Error scanning map %s: %s", team_map.map_id, e)
+
+watcher = DirectoryWatcher()
+
+# Lazily creates maps on first use and drops idle ones so memory tracks active maps only
+class MapRegistry:
+    def __init__(self):
+        self.lock = Lock()
+        self.maps = {}
+        self.last_sweep = time.monotonic()
+
+    def pins_dir(self, map_id):
+        return PINS_DIR if map_id == DEFAULT_MAP_ID else os.path.join(MAPS_DIR, map_id)
+
+    def acquire(self, map_id):
+        now = time.monotonic()
+        opened, evicted = None, []
+        with self.lock:
+            team_map = self.maps.get(map_id)
+            if team_map is None:
+                team_map = opened = self.maps[map_id] = TeamMap(map_id, self.pins_dir(map_id))
+            team_map.active_requests += 1
+            team_map.last_used = now
+            if now - self.last_sweep > 60:
+                self.last_sweep = now
+                evicted = self._evict_idle(now)
+        # Watcher bookkeeping happens outside the registry lock so one map can't stall the rest
+        if opened is not None:
+            watcher.watch(opened)
+            logger.info("Opened map: %s", map_id)
+        for idle_map in evicted:
+            watcher.unwatch(idle_map)
+            logger.info("Evicted idle map: %s", idle_map.map_id)
+        return team_map
+
+    def release(self, team_map):
+        with self.lock:
+            team_map.active_requests -= 1
+            team_map.last_used = time.monotonic()
+
+    def _evict_idle(self, now):
+        evicted = []
+        for map_id, team_map in list(self.maps.items()):
+            if map_id != DEFAULT_MAP_ID and team_map.is_idle(now):
+                del self.maps[map_id]
+                evicted.append(team_map)
+        return evicted
+
+    def active(self):
+        with self.lock:
+            return list(self.maps.values())
+
+maps = MapRegistry()
+
+def current_map():
+    # Bound on first use in a request and released on teardown
+    if 'team_map' not in g:
+        g.team_map = maps.acquire(g.get('map_id', DEFAULT_MAP_ID))
+    return g.team_map
+
+def write_snapshots():
+    for team_map in maps.active():
+        try:
+            team_map.store.write_snapshot()
+        except Exception as e:
+            logger.error("Error writing snapshot for map %s: %s", team_map.map_id, e)
+
+def snapshot_loop():
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        write_snapshots()
+
+def archive_maps():
+    for team_map in maps.active():
+        try:
+            team_map.store.archive_old(ARCHIVE_AFTER_DAYS, ARCHIVE_KEEP_NEWEST)
+        except Exception as e:
+            logger.error("Error archiving pins for map %s: %s", team_map.map_id, e)
+
+def archive_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL)
+        archive_maps()
+
+# Load the default map in the background so the first request doesn't pay for it
+startup = {'started': time.monotonic(), 'ready_seconds': None}
+
+def warm_up():
+    team_map = maps.acquire(DEFAULT_MAP_ID)
+    try:
+        team_map.store.load()
+    except Exception as e:
+        logger.error("Error loading default map: %s", e)
+        return
+    finally:
+        maps.release(team_map)
+    startup['ready_seconds'] = time.monotonic() - startup['started']
+    logger.info("Ready after %.2fs", startup['ready_seconds'])
+
+threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+threading.Thread(target=snapshot_loop, name='snapshot-writer', daemon=True).start()
+if ARCHIVE_AFTER_DAYS or ARCHIVE_KEEP_NEWEST:
+    threading.Thread(target=archive_loop, name='archiver', daemon=True).start()
+watcher.start()
+atexit.register(write_snapshots)
+
+def coalesced(name, fn):
+    team_map = current_map()
+    return team_map.single_flight.do((name, team_map.store.version), fn)
+
+def map_route(rule, **options):
+    # Serves a route both for the default map and under /maps/<map_id>
+    def decorator(view):
+        app.route(rule, **options)(view)
+        app.route(f'/maps/<map_id>{rule}', **options)(view)
+        return view
+    return decorator
+
+@app.url_value_preprocessor
+def pull_map_id(endpoint, values):
+    g.map_id = values.pop('map_id', DEFAULT_MAP_ID) if values else DEFAULT_MAP_ID
+
+@app.before_request
+def validate_map_id():
+    if not MAP_ID_PATTERN.fullmatch(g.map_id):
+        return jsonify({'status': 'error', 'message': 'Invalid map id'}), 404
+
+@app.teardown_request
+def release_map(exc):
+    team_map = g.pop('team_map', None)
+    if team_map is not None:
+        maps.release(team_map)
+
+def load_locations(map_id=DEFAULT_MAP_ID):
+    team_map = maps.acquire(map_id)
+    try:
+        return {'status': 'success', 'pins': team_map.store.all()}
         
     except Exception as e:
-        logger.error(f"Error loading locations: {e}")
+        logger.error("Error loading locations: %s", e)
         return {'status': 'error', 'message': str(e)}
+    finally:
+        maps.release(team_map)
 
 @app.route('/')
 def serve_index():
     return send_from_directory(app.static_folder, 'index.html')
 
-@app.route('/pins', methods=['GET', 'POST'])
+# Upper bounds for GET /pins?limit=, /pins/search?limit= and /pins/nearby?k=
+MAX_PAGE_SIZE = 1000
+MAX_SEARCH_RESULTS = 100
+MAX_NEARBY_RESULTS = 100
+
+# Heat cells are this many grid levels finer than the map zoom
+HEATMAP_LEVEL_OFFSET = 2
+
+def build_pins_listing():
+    store = current_map().store
+    # Newest first, from the timestamp index
+    pins = store.all()
+    polling_logger.info('GET /pins - Returning %s pins', len(pins))
+    return json.dumps({'status': 'success', 'pins': pins})
+
+def build_full_pins_listing():
+    store = current_map().store
+    # Hot and archived pins merged, newest first
+    pins = store.all(include_archived=True)
+    polling_logger.info('GET /pins - Returning %s pins including archived', len(pins))
+    return json.dumps({'status': 'success', 'pins': pins})
+
+@map_route('/pins', methods=['GET', 'POST'])
 def handle_pins():
+    store = current_map().store
+    broadcaster = current_map().broadcaster
     if request.method == 'GET':
         try:
-            logger.info('GET /pins - Fetching all pins')
-            pins = []
-            for filename in os.listdir(PINS_DIR):
-                if filename.endswith('.json'):
-                    with open(os.path.join(PINS_DIR, filename), 'r') as f:
-                        pin_data = json.load(f)
-                        # Add the pin ID to the data
-                        pin_data['id'] = filename.replace('.json', '')
-                        pins.append(pin_data)
-            
-            # Sort pins by timestamp if available
-            pins.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-            logger.info(f'GET /pins - Returning {len(pins)} pins')
-            return jsonify({'status': 'success', 'pins': pins})
+            limit = request.args.get('limit')
+            cursor = request.args.get('cursor')
+            include_archived = request.args.get('include_archived', '').lower() in ('1', 'true', 'yes')
+            if limit is None and cursor is None:
+                polling_logger.info('GET /pins - Fetching all pins')
+                if include_archived:
+                    return Response(coalesced('pins_archived', build_full_pins_listing), mimetype='application/json')
+                return Response(coalesced('pins', build_pins_listing), mimetype='application/json')
+            
+            # Keyset pagination: the cursor is the (timestamp, id) of the last pin returned
+            try:
+                limit = min(int(limit or 50), MAX_PAGE_SIZE)
+                if limit < 1:
+                    raise ValueError('limit must be positive')
+                pins, next_cursor = store.page(limit, cursor, include_archived)
+            except ValueError as e:
+                return jsonify({'status': 'error', 'message': str(e)}), 400
+            return jsonify({'status': 'success', 'pins': pins, 'nextCursor': next_cursor})
             
         except Exception as e:
-            logger.error(f"Error getting pins: {str(e)}")
+            logger.error("Error getting pins: %s", e)
             return jsonify({'status': 'error', 'message': str(e)})
     
     elif request.method == 'POST':
         try:
             logger.info('POST /pins - Creating new pin')
-            logger.debug(f'Request data: {request.data}')
+            logger.debug('Request data: %s', request.data)
             data = request.json
-            logger.info(f'Parsed JSON data: {data}')
+            logger.debug('Parsed JSON data: %s', data)
             
             # Create pin data
             pin_data = {
@@ -191,74 +1685,109 @@ def handle_pins():
                 'imageUrl': data.get('imageUrl', ''),
                 'timestamp': datetime.now().isoformat()
             }
-            logger.info(f'Created pin data: {pin_data}')
+            if not (math.isfinite(pin_data['lat']) and math.isfinite(pin_data['lng'])):
+                return jsonify({'status': 'error', 'message': 'lat and lng must be finite numbers'}), 400
+            logger.debug('Created pin data: %s', pin_data)
             
             # Get location name using reverse geocoding
             location_name = get_nearest_city(pin_data['lat'], pin_data['lng'])
             if location_name:
                 pin_data['location'] = location_name
-                logger.info(f'Added location: {location_name}')
+                logger.info('Added location: %s', location_name)
             
             # Generate unique ID
             pin_id = str(uuid.uuid4())
             pin_data['id'] = pin_id
             
             # Save pin data
-            pin_file = os.path.join(PINS_DIR, f'{pin_id}.json')
-            with open(pin_file, 'w') as f:
-                json.dump(pin_data, f, indent=2)
-            logger.info(f'Saved pin to file: {pin_file}')
+            store.save(pin_data)
+            logger.info('Saved pin: %s', pin_id)
             
             # Broadcast update
             broadcaster.broadcast(json.dumps({
                 'type': 'pin_added',
                 'pin': pin_data
             }))
-            logger.info('Broadcasted pin update')
-            
+                        
             return jsonify({
                 'status': 'success',
                 'pin': pin_data
             })
             
         except Exception as e:
-            logger.error(f"Error creating pin: {str(e)}", exc_info=True)
+            logger.error("Error creating pin: %s", e, exc_info=True)
             return jsonify({'status': 'error', 'message': str(e)})
 
-@app.route('/pins/<pin_id>', methods=['DELETE'])
+@map_route('/pins/search', methods=['GET'])
+def search_pins():
+    store = current_map().store
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'status': 'error', 'message': 'Query parameter q is required'}), 400
+    try:
+        limit = min(int(request.args.get('limit', 20)), MAX_SEARCH_RESULTS)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'limit must be an integer'}), 400
+    return jsonify({'status': 'success', 'pins': store.search(query, max(limit, 1))})
+
+@map_route('/pins/nearby', methods=['GET'])
+def nearby_pins():
+    store = current_map().store
+    try:
+        lat = float(request.args['lat'])
+        lng = float(request.args['lng'])
+        k = min(int(request.args.get('k', 10)), MAX_NEARBY_RESULTS)
+        radius_km = request.args.get('radius_km')
+        radius_km = float(radius_km) if radius_km else None
+        if k < 1 or not (math.isfinite(lat) and math.isfinite(lng)):
+            raise ValueError
+        if radius_km is not None and (not math.isfinite(radius_km) or radius_km <= 0):
+            raise ValueError
+    except (KeyError, ValueError):
+        return jsonify({'status': 'error', 'message': 'lat and lng are required; k and radius_km must be positive numbers'}), 400
+    return jsonify({'status': 'success', 'pins': store.nearby(lat, lng, k, radius_km)})
+
+@map_route('/pins/<pin_id>', methods=['GET'])
+def get_pin(pin_id):
+    store = current_map().store
+    try:
+        pin, archived = store.get_any(pin_id)
+        if pin is None:
+            return jsonify({'status': 'error', 'message': 'Pin not found'}), 404
+        return jsonify({'status': 'success', 'pin': pin, 'archived': archived})
+    except Exception as e:
+        logger.error("Error getting pin: %s", e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@map_route('/pins/<pin_id>', methods=['DELETE'])
 def delete_pin(pin_id):
+    store = current_map().store
     try:
-        pin_file = os.path.join(PINS_DIR, f"{pin_id}.json")
-        if os.path.exists(pin_file):
-            os.remove(pin_file)
-            logger.info(f"Pin deleted: {pin_id}")
+        if store.delete(pin_id):
+            logger.info("Pin deleted: %s", pin_id)
             return jsonify({'status': 'success', 'message': 'Pin deleted successfully'})
         else:
-            logger.warning(f"Pin not found: {pin_id}")
+            logger.warning("Pin not found: %s", pin_id)
             return jsonify({'status': 'error', 'message': 'Pin not found'}), 404
     except Exception as e:
-        logger.error(f"Error deleting pin: {e}")
+        logger.error("Error deleting pin: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
-@app.route('/pins/<pin_id>/connections', methods=['POST'])
+@map_route('/pins/<pin_id>/connections', methods=['POST'])
 def create_connection(pin_id):
+    store = current_map().store
     try:
-        # Get the pin file
-        pin_file = os.path.join(PINS_DIR, f'{pin_id}.json')
-        if not os.path.exists(pin_file):
-            return jsonify({'status': 'error', 'message': 'Source pin not found'})
-        
         # Load pin data
-        with open(pin_file, 'r') as f:
-            pin_data = json.load(f)
+        pin_data = store.get(pin_id)
+        if pin_data is None:
+            return jsonify({'status': 'error', 'message': 'Source pin not found'})
         
         # Get connection data
         connection_data = request.json
         target_pin_id = connection_data.get('targetPinId')
         
         # Validate target pin exists
-        target_pin_file = os.path.join(PINS_DIR, f'{target_pin_id}.json')
-        if not os.path.exists(target_pin_file):
+        if store.get(target_pin_id) is None:
             return jsonify({'status': 'error', 'message': 'Target pin not found'})
         
         # Initialize connections list if it doesn't exist
@@ -278,26 +1807,22 @@ def create_connection(pin_id):
         })
         
         # Save updated pin data
-        with open(pin_file, 'w') as f:
-            json.dump(pin_data, f, indent=2)
+        store.save(pin_data)
         
         return jsonify({'status': 'success'})
         
     except Exception as e:
-        print(f"Error creating connection: {str(e)}")
+        logger.error("Error creating connection: %s", e)
         return jsonify({'status': 'error', 'message': str(e)})
 
-@app.route('/pins/<pin_id>/connections', methods=['GET'])
+@map_route('/pins/<pin_id>/connections', methods=['GET'])
 def get_connections(pin_id):
+    store = current_map().store
     try:
-        # Get the pin file
-        pin_file = os.path.join(PINS_DIR, f'{pin_id}.json')
-        if not os.path.exists(pin_file):
-            return jsonify({'status': 'error', 'message': 'Pin not found'})
-        
         # Load pin data
-        with open(pin_file, 'r') as f:
-            pin_data = json.load(f)
+        pin_data = store.get(pin_id)
+        if pin_data is None:
+            return jsonify({'status': 'error', 'message': 'Pin not found'})
         
         # Return connections
         return jsonify({
@@ -306,20 +1831,17 @@ def get_connections(pin_id):
         })
         
     except Exception as e:
-        print(f"Error getting connections: {str(e)}")
+        logger.error("Error getting connections: %s", e)
         return jsonify({'status': 'error', 'message': str(e)})
 
-@app.route('/pins/<pin_id>/connections/<target_pin_id>', methods=['DELETE'])
+@map_route('/pins/<pin_id>/connections/<target_pin_id>', methods=['DELETE'])
 def delete_connection(pin_id, target_pin_id):
+    store = current_map().store
     try:
-        # Get the pin file
-        pin_file = os.path.join(PINS_DIR, f'{pin_id}.json')
-        if not os.path.exists(pin_file):
-            return jsonify({'status': 'error', 'message': 'Pin not found'})
-        
         # Load pin data
-        with open(pin_file, 'r') as f:
-            pin_data = json.load(f)
+        pin_data = store.get(pin_id)
+        if pin_data is None:
+            return jsonify({'status': 'error', 'message': 'Pin not found'})
         
         # Remove connection
         pin_data['connections'] = [
@@ -328,26 +1850,26 @@ def delete_connection(pin_id, target_pin_id):
         ]
         
         # Save updated pin data
-        with open(pin_file, 'w') as f:
-            json.dump(pin_data, f, indent=2)
+        store.save(pin_data)
         
         return jsonify({'status': 'success'})
         
     except Exception as e:
-        print(f"Error deleting connection: {str(e)}")
+        logger.error("Error deleting connection: %s", e)
         return jsonify({'status': 'error', 'message': str(e)})
 
-@app.route('/stream')
+@map_route('/stream')
 def stream():
+    broadcaster = current_map().broadcaster
     def event_stream():
         # Create a queue for this client
         client_queue = queue.Queue()
         client_id = str(uuid.uuid4())
-        logger.info(f"New client connected: {client_id}")
+        logger.info("New client connected: %s", client_id)
         
         try:
             # Register client
-            broadcaster.register(client_queue)
+            broadcaster.register(client_queue, client_id)
             
             while True:
                 # Get message from queue
@@ -357,29 +1879,22 @@ def stream():
                     break
                     
                 # Send message to client
-                yield f"data: {message}\n\n"
+                event = f"data: {message}\n\n"
+                metrics.inc('sse_bytes_sent_total', len(event.encode('utf-8')))
+                yield event
                 
         except GeneratorExit:
-            logger.info(f"Client disconnected: {client_id}")
+            logger.info("Client disconnected: %s", client_id)
         finally:
             broadcaster.unregister(client_queue)
             client_queue.put(None)  # Signal to exit
     
     return Response(event_stream(), mimetype='text/event-stream')
 
-@app.route('/generate-light-map')
-def generate_light_map():
-    # Get all pins
-    pins = []
-    if os.path.exists(PINS_DIR):
-        for pin_file in os.listdir(PINS_DIR):
-            if pin_file.endswith('.json'):
-                with open(os.path.join(PINS_DIR, pin_file), 'r') as f:
-                    pin = json.load(f)
-                    pins.append(pin)
-    
-    # Sort pins by timestamp
-    pins.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
+def build_light_map():
+    store = current_map().store
+    # Get all pins, newest first
+    pins = store.all()
     
     # Generate HTML template
     html_template = '''<!DOCTYPE html>
@@ -715,6 +2230,50 @@ def generate_light_map():
     </script>
 </body>
 </html>'''
+    return html_template
+
+def parse_bbox(bbox):
+    # Leaflet's toBBoxString() order: west,south,east,north
+    west, south, east, north = (float(value) for value in bbox.split(','))
+    if not all(math.isfinite(value) for value in (west, south, east, north)) or south > north:
+        raise ValueError('Invalid bbox')
+    south, north = max(south, -90.0), min(north, 90.0)
+    if east - west >= 360:
+        return [(south, -180.0, north, 180.0)]
+    # Normalize longitudes and split boxes that cross the antimeridian; +/-180 are kept as
+    # given except where they'd otherwise produce an empty sliver on the far side
+    if not -180.0 <= west <= 180.0:
+        west = (west + 180.0) % 360.0 - 180.0
+    if not -180.0 <= east <= 180.0:
+        east = (east + 180.0) % 360.0 - 180.0
+    if west == 180.0:
+        west = -180.0
+    if east == -180.0:
+        east = 180.0
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+@map_route('/heatmap', methods=['GET'])
+def heatmap():
+    store = current_map().store
+    try:
+        zoom = int(request.args.get('zoom', 2))
+        boxes = parse_bbox(request.args.get('bbox', '-180,-90,180,90'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f'zoom must be an integer and bbox west,south,east,north: {e}'}), 400
+    # Roughly 8x8 heat cells per 256px map tile
+    level = max(0, min(zoom + HEATMAP_LEVEL_OFFSET, GeoIndex.LEVELS - 1))
+    return jsonify({
+        'status': 'success',
+        'zoom': zoom,
+        'cellSize': 180.0 / (1 << level),
+        'cells': store.heatmap(level, boxes)
+    })
+
+@map_route('/generate-light-map')
+def generate_light_map():
+    html_template = coalesced('light_map', build_light_map)
 
     # Send as downloadable file
     response = make_response(html_template)
@@ -733,8 +2292,8 @@ def get_random_gif():
                 'message': 'GIPHY_API_KEY environment variable is not set'
             }), 500
 
-        url = f"https://api.giphy.com/v1/gifs/random?api_key={GIPHY_API_KEY}&rating=g"
-        logger.info(f"Making request to Giphy API: {url.replace(GIPHY_API_KEY, '[REDACTED]')}")
+        url = f"{GIPHY_API_URL}/v1/gifs/random?api_key={GIPHY_API_KEY}&rating=g"
+        logger.info("Making request to Giphy API: %s/v1/gifs/random", GIPHY_API_URL)
         
         response = requests.get(url)
         response.raise_for_status()  # Raise exception for bad status codes
@@ -744,34 +2303,36 @@ def get_random_gif():
         
         if data.get('data', {}).get('images', {}).get('original', {}).get('url'):
             gif_url = data['data']['images']['original']['url']
-            logger.info(f"Successfully got GIF URL: {gif_url}")
+            logger.info("Successfully got GIF URL: %s", gif_url)
             return jsonify({
                 'status': 'success',
                 'url': gif_url
             })
         else:
             logger.error("Could not fetch GIF from Giphy: No URL in response")
-            logger.error(f"Response data: {json.dumps(data)}")
+            logger.error("Response data: %s", data)
             return jsonify({
                 'status': 'error',
                 'message': 'Could not fetch GIF from Giphy'
             }), 500
     except requests.RequestException as e:
-        logger.error(f"Network error while fetching GIF: {str(e)}")
+        logger.error("Network error while fetching GIF: %s", e)
         return jsonify({
             'status': 'error',
             'message': f'Network error: {str(e)}'
         }), 500
     except Exception as e:
-        logger.error(f"Unexpected error while fetching GIF: {str(e)}")
+        logger.error("Unexpected error while fetching GIF: %s", e)
         logger.exception("Full traceback:")
         return jsonify({
             'status': 'error',
             'message': f'Error: {str(e)}'
         }), 500
 
-@app.route('/connections', methods=['POST'])
+@map_route('/connections', methods=['POST'])
 def create_connection_new():
+    store = current_map().store
+    broadcaster = current_map().broadcaster
     try:
         data = request.json
         source_id = data.get('sourceId')
@@ -784,16 +2345,14 @@ def create_connection_new():
             }), 400
             
         # Load source pin
-        source_file = os.path.join(PINS_DIR, f'{source_id}.json')
-        if not os.path.exists(source_file):
+        if store.get(source_id) is None:
             return jsonify({
                 'status': 'error',
                 'message': 'Source pin not found'
             }), 404
             
         # Load target pin
-        target_file = os.path.join(PINS_DIR, f'{target_id}.json')
-        if not os.path.exists(target_file):
+        if store.get(target_id) is None:
             return jsonify({
                 'status': 'error',
                 'message': 'Target pin not found'
@@ -818,22 +2377,18 @@ def create_connection_new():
         }
             
         # Update source pin
-        with open(source_file, 'r') as f:
-            source_pin = json.load(f)
+        source_pin = store.get(source_id)
         if 'connections' not in source_pin:
             source_pin['connections'] = []
         source_pin['connections'].append(source_connection)
-        with open(source_file, 'w') as f:
-            json.dump(source_pin, f, indent=2)
+        store.save(source_pin)
             
         # Update target pin
-        with open(target_file, 'r') as f:
-            target_pin = json.load(f)
+        target_pin = store.get(target_id)
         if 'connections' not in target_pin:
             target_pin['connections'] = []
         target_pin['connections'].append(target_connection)
-        with open(target_file, 'w') as f:
-            json.dump(target_pin, f, indent=2)
+        store.save(target_pin)
             
         # Broadcast update
         broadcaster.broadcast(json.dumps({
@@ -847,47 +2402,51 @@ def create_connection_new():
         })
         
     except Exception as e:
-        logger.error(f"Error creating connection: {str(e)}")
+        logger.error("Error creating connection: %s", e)
         return jsonify({'status': 'error', 'message': str(e)})
 
-@app.route('/connections', methods=['GET'])
+def build_connections_listing():
+    store = current_map().store
+    connections = {}  # Use a dict to deduplicate by connection ID
+    # Get connections from all pins
+    pins = store.all()
+    pin_ids = {pin_data['id'] for pin_data in pins}
+    for pin_data in pins:
+        for connection in pin_data.get('connections', []):
+            # Skip connections to archived pins, which clients won't have from /pins
+            if connection.get('sourceId', pin_data['id']) in pin_ids and connection.get('targetId') in pin_ids:
+                connections[connection['id']] = connection
+    
+    # Connections are only known after a full pass, so expose the last count seen
+    store.connections_count = len(connections)
+    
+    return json.dumps({
+        'status': 'success',
+        'connections': list(connections.values())
+    })
+
+@map_route('/connections', methods=['GET'])
 def get_connections_new():
     try:
-        connections = {}  # Use a dict to deduplicate by connection ID
-        # Get connections from all pins
-        for filename in os.listdir(PINS_DIR):
-            if filename.endswith('.json'):
-                with open(os.path.join(PINS_DIR, filename), 'r') as f:
-                    pin_data = json.load(f)
-                    if 'connections' in pin_data:
-                        for connection in pin_data['connections']:
-                            connections[connection['id']] = connection
-        
-        return jsonify({
-            'status': 'success',
-            'connections': list(connections.values())
-        })
+        return Response(coalesced('connections', build_connections_listing), mimetype='application/json')
         
     except Exception as e:
-        logger.error(f"Error getting connections: {str(e)}")
+        logger.error("Error getting connections: %s", e)
         return jsonify({'status': 'error', 'message': str(e)})
 
-@app.route('/connections/<source_id>/<target_id>', methods=['DELETE'])
+@map_route('/connections/<source_id>/<target_id>', methods=['DELETE'])
 def delete_connection_new(source_id, target_id):
+    store = current_map().store
     try:
-        # Get the source pin file
-        source_file = os.path.join(PINS_DIR, f'{source_id}.json')
-        if not os.path.exists(source_file):
+        # Check both pins exist
+        if store.get(source_id) is None:
             return jsonify({'status': 'error', 'message': 'Source pin not found'})
         
-        # Get the target pin file
-        target_file = os.path.join(PINS_DIR, f'{target_id}.json')
-        if not os.path.exists(target_file):
+        if store.get(target_id) is None:
             return jsonify({'status': 'error', 'message': 'Target pin not found'})
         
         # Load source pin data and remove connection
-        with open(source_file, 'r') as f:
-            source_data = json.load(f)
+        source_data = store.get(source_id)
         
         # Remove all connections between these two pins
         source_data['connections'] = [
@@ -897,12 +2456,10 @@ def delete_connection_new(source_id, target_id):
         ]
         
         # Save updated source pin data
-        with open(source_file, 'w') as f:
-            json.dump(source_data, f, indent=2)
+        store.save(source_data)
         
         # Load target pin data and remove connection
-        with open(target_file, 'r') as f:
-            target_data = json.load(f)
+        target_data = store.get(target_id)
         
         # Remove all connections between these two pins
         target_data['connections'] = [
@@ -912,15 +2469,26 @@ def delete_connection_new(source_id, target_id):
         ]
         
         # Save updated target pin data
-        with open(target_file, 'w') as f:
-            json.dump(target_data, f, indent=2)
+        store.save(target_data)
         
         return jsonify({'status': 'success'})
         
     except Exception as e:
-        logger.error(f"Error deleting connection: {str(e)}")
+        logger.error("Error deleting connection: %s", e)
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(request.method, route, response.status_code, time.perf_counter() - started)
+    return response
+
 @app.after_request
 def add_cors_headers(response):
     # Get the request origin or use a default value
@@ -930,38 +2498,159 @@ def add_cors_headers(response):
     response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
     return response
 
-@app.route('/download-pins', methods=['GET'])
+def build_pins_zip():
+    store = current_map().store
+    pins_dir = store.pins_dir
+    # Create a BytesIO object to store the ZIP file
+    zip_buffer = BytesIO()
+    
+    # Create a ZIP file
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        # Add all pin files to the ZIP
+        filenames = os.listdir(pins_dir) if os.path.isdir(pins_dir) else []
+        for filename in filenames:
+            if filename.endswith('.json'):
+                file_path = os.path.join(pins_dir, filename)
+                zip_file.write(file_path, filename)
+                metrics.inc('disk_reads_total')
+        
+        # Archived pins come along as-is, so unzipping into pins/ restores both tiers
+        for archive_path in store.archive_files():
+            zip_file.write(os.path.join(pins_dir, archive_path), archive_path)
+            metrics.inc('disk_reads_total')
+    
+    return zip_buffer.getvalue()
+
+@map_route('/download-pins', methods=['GET'])
 def download_pins():
     try:
-        # Create a BytesIO object to store the ZIP file
-        zip_buffer = BytesIO()
-        
-        # Create a ZIP file
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Add all pin files to the ZIP
-            for filename in os.listdir(PINS_DIR):
-                if filename.endswith('.json'):
-                    file_path = os.path.join(PINS_DIR, filename)
-                    zip_file.write(file_path, filename)
-        
-        # Seek to the beginning of the BytesIO buffer
-        zip_buffer.seek(0)
-        
         # Create the response
-        response = make_response(zip_buffer.getvalue())
+        response = make_response(coalesced('pins_zip', build_pins_zip))
         response.headers['Content-Type'] = 'application/zip'
         response.headers['Content-Disposition'] = 'attachment; filename=pins.zip'
         
         return response
         
     except Exception as e:
-        logger.error(f"Error creating ZIP file: {str(e)}")
+        logger.error("Error creating ZIP file: %s", e)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    sse_clients, queue_depths, pins, archived_pins, connections = [], [], [], [], []
+    active_maps = maps.active()
+    for team_map in active_maps:
+        label = f'map="{team_map.map_id}"'
+        depths = team_map.broadcaster.queue_depths()
+        sse_clients.append((label, len(depths)))
+        queue_depths.extend((f'{label},client="{client_id}"', depth) for client_id, depth in depths)
+        # Only report maps already in memory; scraping must not load evicted ones
+        if team_map.store.pins is not None:
+            pins.append((label, team_map.store.count()))
+            archived_pins.append((label, team_map.store.archive.count()))
+            connections.append((label, team_map.store.connections_count))
+    body = metrics.render({
+        'active_maps': len(active_maps),
+        'startup_ready_seconds': startup['ready_seconds'] if startup['ready_seconds'] is not None else 'NaN',
+        'sse_clients': sse_clients,
+        'sse_client_queue_depth': queue_depths,
+        'geocode_cache_entries': len(location_cache),
+        'pins': pins,
+        'archived_pins': archived_pins,
+        'connections': connections,
+    })
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@app.route('/health', methods=['GET'])
+def health():
+    if startup['ready_seconds'] is None:
+        return jsonify({'status': 'starting'}), 503
+    return jsonify({'status': 'ok', 'readySeconds': round(startup['ready_seconds'], 3)})
+
 @app.route('/options', methods=['OPTIONS'])
 def handle_options():
     return '', 204
 
+backfill_lock = Lock()
+
+def start_backfill(team_map, batch_size=BACKFILL_BATCH_SIZE):
+    # Returns None if a backfill is already running for this map
+    with backfill_lock:
+        if team_map.backfill is not None and team_map.backfill.state in ('pending', 'running'):
+            return None
+        job = team_map.backfill = LocationBackfill(team_map, batch_size)
+    # Hold the map for the job's lifetime so it isn't evicted mid-run
+    held = maps.acquire(team_map.map_id)
+
+    def run():
+        try:
+            job.run()
+        finally:
+            maps.release(held)
+
+    thread = threading.Thread(target=run, name=f'backfill-{team_map.map_id}', daemon=True)
+    thread.start()
+    return job, thread
+
+def check_admin_token():
+    if not ADMIN_TOKEN:
+        return jsonify({'status': 'error', 'message': 'Admin endpoints are disabled; set ADMIN_TOKEN to enable them'}), 403
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    return None
+
+@map_route('/admin/backfill-locations', methods=['GET', 'POST'])
+def backfill_locations():
+    denied = check_admin_token()
+    if denied:
+        return denied
+    team_map = current_map()
+    if request.method == 'GET':
+        if team_map.backfill is None:
+            return jsonify({'status': 'error', 'message': 'No backfill has run for this map'}), 404
+        return jsonify({'status': 'success', 'backfill': team_map.backfill.status()})
+
+    try:
+        batch_size = int(request.args.get('batch_size', BACKFILL_BATCH_SIZE))
+        if batch_size < 1:
+            raise ValueError('batch_size must be positive')
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    started = start_backfill(team_map, batch_size)
+    if started is None:
+        return jsonify({'status': 'error', 'message': 'Backfill already running',
+                        'backfill': team_map.backfill.status()}), 409
+    job, _ = started
+    logger.info("Started location backfill for map %s", team_map.map_id)
+    return jsonify({'status': 'success', 'backfill': job.status()}), 202
+
+@app.cli.command('backfill-locations')
+@click.option('--map', 'map_id', default=DEFAULT_MAP_ID, show_default=True, help='Map to backfill.')
+@click.option('--batch-size', default=BACKFILL_BATCH_SIZE, show_default=True, type=click.IntRange(min=1),
+              help='Pins saved per batch.')
+def backfill_locations_command(map_id, batch_size):
+    """Geocode pins whose location is missing or unknown."""
+    if not MAP_ID_PATTERN.fullmatch(map_id):
+        raise click.BadParameter('invalid map id', param_hint='--map')
+    team_map = maps.acquire(map_id)
+    try:
+        job, thread = start_backfill(team_map, batch_size)
+        try:
+            while thread.is_alive():
+                thread.join(5)
+                status = job.status()
+                click.echo(f"{status['cellsDone']}/{status['cellsTotal']} cells, "
+                           f"{status['pinsUpdated']}/{status['pinsTotal']} pins updated")
+        except KeyboardInterrupt:
+            raise click.ClickException('Interrupted; run again to resume from the last resolved cell')
+    finally:
+        maps.release(team_map)
+    status = job.status()
+    if status['state'] == 'failed':
+        raise click.ClickException(status['error'])
+    click.echo(f"Done: {status['pinsUpdated']} pins updated, {status['cellsFailed']} cells still unresolved")
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5002))
     app.run(host='0.0.0.0', port=port, debug=False)
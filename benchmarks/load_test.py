@@ -0,0 +1,405 @@
+"""Load test for the team map backend.
+
+Starts app.py against a temporary PINS_DIR seeded with synthetic pins and
+local stand-ins for Nominatim and Giphy, replays a mix of polling, SSE and
+write traffic, and writes throughput/latency/RSS results as JSON.
+
+    python benchmarks/load_test.py --pins 1000 10000 --duration 30
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+DELIVERY_GRACE_SECONDS = 1.0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers Nominatim reverse lookups and Giphy random GIF requests."""
+
+    def do_GET(self):
+        if self.path.startswith('/reverse'):
+            body = {'address': {'city': 'Stubville'}, 'display_name': 'Stubville, Nowhere'}
+        elif self.path.startswith('/v1/gifs/random'):
+            body = {'data': {'images': {'original': {'url': 'https://example.com/stub.gif'}}}}
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def seed_pins(pins_dir, count, connections_per_pin):
+    start = datetime.now() - timedelta(days=365)
+    ids = [str(uuid.uuid4()) for _ in range(count)]
+    pins = {}
+    for i, pin_id in enumerate(ids):
+        pins[pin_id] = {
+            'id': pin_id,
+            'lat': random.uniform(-60, 70),
+            'lng': random.uniform(-180, 180),
+            'name': f'Person {i}',
+            'imageUrl': '',
+            'location': f'City {i % 500}',
+            'timestamp': (start + timedelta(seconds=i * 30)).isoformat(),
+            'connections': [],
+        }
+    for pin_id in ids:
+        for target_id in random.sample(ids, min(connections_per_pin, count)):
+            if target_id == pin_id:
+                continue
+            connection = {
+                'id': str(uuid.uuid4()),
+                'sourceId': pin_id,
+                'targetId': target_id,
+                'timestamp': datetime.now().isoformat(),
+            }
+            pins[pin_id]['connections'].append(connection)
+            pins[target_id]['connections'].append(connection)
+    for pin_id, pin in pins.items():
+        with open(os.path.join(pins_dir, f'{pin_id}.json'), 'w') as f:
+            json.dump(pin, f, indent=2)
+    return ids
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples, errors, duration):
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'throughput_rps': round(len(samples) / duration, 2),
+        'p50_ms': round(percentile(samples, 50) * 1000, 2) if samples else None,
+        'p95_ms': round(percentile(samples, 95) * 1000, 2) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 2) if samples else None,
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, name, seconds=None):
+        with self.lock:
+            self.samples.setdefault(name, [])
+            self.errors.setdefault(name, 0)
+            if seconds is None:
+                self.errors[name] += 1
+            else:
+                self.samples[name].append(seconds)
+
+
+def timed_request(recorder, name, method, url, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = requests.request(method, url, timeout=30, **kwargs)
+        response.raise_for_status()
+    except requests.RequestException:
+        recorder.record(name)
+        return None
+    recorder.record(name, time.perf_counter() - started)
+    return response
+
+
+def poller(base_url, recorder, stop, interval):
+    # Stagger clients so they do not all fire in lockstep
+    stop.wait(random.uniform(0, interval))
+    while not stop.is_set():
+        timed_request(recorder, 'GET /pins', 'GET', f'{base_url}/pins')
+        timed_request(recorder, 'GET /connections', 'GET', f'{base_url}/connections')
+        stop.wait(interval)
+
+
+class BroadcastTracker:
+    """Matches pin_added events seen by subscribers to the POST that created each pin."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = {}  # pin id -> when its POST started
+        self.arrivals = {}  # pin id -> arrival times, one per subscriber that saw it
+        self.events = 0
+
+    def posted(self, pin_id, started):
+        with self.lock:
+            self.sent[pin_id] = started
+
+    def received(self, message, arrived):
+        with self.lock:
+            self.events += 1
+            if message.get('type') == 'pin_added':
+                self.arrivals.setdefault(message['pin']['id'], []).append(arrived)
+
+    def record(self, recorder, subscribers):
+        # An event can arrive before its POST returns, so pairs are matched only once traffic has stopped
+        with self.lock:
+            for pin_id, started in self.sent.items():
+                arrivals = self.arrivals.get(pin_id, [])
+                for arrived in arrivals:
+                    recorder.record('SSE delivery', arrived - started)
+                for _ in range(subscribers - len(arrivals)):
+                    recorder.record('SSE delivery')
+
+
+def subscriber(base_url, tracker):
+    # Reads until the server goes away at the end of the scenario
+    try:
+        with requests.get(f'{base_url}/stream', stream=True, timeout=(5, None)) as response:
+            for line in response.iter_lines():
+                if line.startswith(b'data:'):
+                    tracker.received(json.loads(line[len(b'data:'):]), time.perf_counter())
+    except (requests.RequestException, ValueError):
+        pass
+
+
+def wait_for_subscribers(base_url, count, timeout=30):
+    # /stream sends no headers until the first event, so ask the server how many clients it has
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        metrics = requests.get(f'{base_url}/metrics', timeout=5).text
+        connected = sum(float(line.split()[-1]) for line in metrics.splitlines()
+                        if line.startswith('team_map_sse_clients'))
+        if connected >= count:
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f'Only {connected:.0f} of {count} SSE subscribers connected within {timeout}s')
+
+
+def writer(base_url, recorder, stop, pin_ids, interval, tracker):
+    created = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = timed_request(recorder, 'POST /pins', 'POST', f'{base_url}/pins', json={
+            'lat': random.uniform(-60, 70),
+            'lng': random.uniform(-180, 180),
+            'name': f'Bench {uuid.uuid4().hex[:6]}',
+        })
+        if response is not None and response.json().get('status') == 'success':
+            created.append(response.json()['pin']['id'])
+            tracker.posted(created[-1], started)
+        candidates = created + pin_ids
+        if len(candidates) >= 2:
+            source_id, target_id = random.sample(candidates, 2)
+            timed_request(recorder, 'POST /connections', 'POST', f'{base_url}/connections',
+                          json={'sourceId': source_id, 'targetId': target_id})
+        stop.wait(interval)
+
+
+def read_peak_rss_kb(pid):
+    # VmHWM is the peak resident set size; only available on Linux
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def wait_for_server(base_url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            # /health answers 503 until the pin store has finished loading
+            if requests.get(f'{base_url}/health', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'Server at {base_url} did not start within {timeout}s')
+
+
+def run_scenario(args, pin_count, stub_url):
+    pins_dir = tempfile.mkdtemp(prefix='team-map-bench-')
+    try:
+        seed_started = time.perf_counter()
+        pin_ids = seed_pins(pins_dir, pin_count, args.connections_per_pin)
+        seed_seconds = time.perf_counter() - seed_started
+
+        port = free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        env = dict(os.environ,
+                   PORT=str(port),
+                   PINS_DIR=pins_dir,
+                   NOMINATIM_URL=stub_url,
+                   GIPHY_API_URL=stub_url,
+                   GIPHY_API_KEY='benchmark',
+                   FLASK_ENV='production')
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            boot_started = time.perf_counter()
+            wait_for_server(base_url)
+            boot_seconds = time.perf_counter() - boot_started
+
+            recorder = Recorder()
+            tracker = BroadcastTracker()
+            stop = threading.Event()
+            subscribers = [
+                threading.Thread(target=subscriber, args=(base_url, tracker), daemon=True)
+                for _ in range(args.subscribers)
+            ]
+            for thread in subscribers:
+                thread.start()
+            # Writes made before every subscriber is registered would count as missed deliveries
+            wait_for_subscribers(base_url, args.subscribers)
+
+            threads = []
+            for _ in range(args.pollers):
+                threads.append(threading.Thread(target=poller, args=(base_url, recorder, stop, args.poll_interval)))
+            for _ in range(args.writers):
+                threads.append(threading.Thread(target=writer, args=(base_url, recorder, stop, pin_ids,
+                                                                     args.write_interval, tracker)))
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+
+            load_started = time.perf_counter()
+            time.sleep(args.duration)
+            stop.set()
+            elapsed = time.perf_counter() - load_started
+            peak_rss_kb = read_peak_rss_kb(server.pid)
+            for thread in threads:
+                thread.join(timeout=30)
+            time.sleep(DELIVERY_GRACE_SECONDS)  # Let the last broadcasts reach every subscriber
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+        for thread in subscribers:
+            thread.join(timeout=5)
+        tracker.record(recorder, args.subscribers)
+
+        if peak_rss_kb is None:
+            # Falls back to the largest RSS of any finished child process
+            peak_rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        return {
+            'pins': pin_count,
+            'seed_seconds': round(seed_seconds, 2),
+            'startup_seconds': round(boot_seconds, 2),
+            'duration_seconds': round(elapsed, 2),
+            'peak_rss_kb': peak_rss_kb,
+            'sse_events_received': tracker.events,
+            'operations': {
+                name: summarize(samples, recorder.errors[name], elapsed)
+                for name, samples in sorted(recorder.samples.items())
+            },
+        }
+    finally:
+        shutil.rmtree(pins_dir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(baseline_path, scenarios):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {scenario['pins']: scenario for scenario in baseline['scenarios']}
+    print(f"Compared with {baseline['commit']}:")
+    for scenario in scenarios:
+        before = previous.get(scenario['pins'])
+        if before is None:
+            continue
+        for name, summary in scenario['operations'].items():
+            old = before['operations'].get(name)
+            if not old or not old['p95_ms'] or summary['p95_ms'] is None:
+                continue
+            change = (summary['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+            print(f"  {scenario['pins']:>7} pins  {name:<18} p95 {old['p95_ms']}ms -> {summary['p95_ms']}ms ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the team map backend')
+    parser.add_argument('--pins', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Synthetic pin counts to seed, one scenario each')
+    parser.add_argument('--connections-per-pin', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of load per scenario')
+    parser.add_argument('--pollers', type=int, default=50, help='Clients polling /pins and /connections')
+    parser.add_argument('--poll-interval', type=float, default=2.0)
+    parser.add_argument('--subscribers', type=int, default=50, help='Open /stream connections')
+    parser.add_argument('--writers', type=int, default=2, help='Clients creating pins and connections')
+    parser.add_argument('--write-interval', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Result file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='Earlier result file to print p95 changes against')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    commit = git_commit()
+
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = f'http://127.0.0.1:{stub.server_address[1]}'
+
+    scenarios = []
+    try:
+        for pin_count in args.pins:
+            print(f'Running scenario with {pin_count} pins...', flush=True)
+            result = run_scenario(args, pin_count, stub_url)
+            for name, summary in result['operations'].items():
+                print(f"  {name:<18} {summary['throughput_rps']:>8} req/s  "
+                      f"p50 {summary['p50_ms']}ms  p95 {summary['p95_ms']}ms  p99 {summary['p99_ms']}ms  "
+                      f"errors {summary['errors']}")
+            print(f"  peak RSS {result['peak_rss_kb']} kB, startup {result['startup_seconds']}s")
+            scenarios.append(result)
+    finally:
+        stub.shutdown()
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created': datetime.now().isoformat(),
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            'scenarios': scenarios,
+        }, f, indent=2)
+    print(f'Results written to {output}')
+    if args.compare:
+        compare(args.compare, scenarios)
+
+
+if __name__ == '__main__':
+    main()
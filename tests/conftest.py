@@ -0,0 +1,52 @@
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# app reads its directories at import time, so point them at a scratch area first
+DATA_DIR = tempfile.mkdtemp(prefix='team-map-tests-')
+os.environ['PINS_DIR'] = os.path.join(DATA_DIR, 'pins')
+os.environ['MAPS_DIR'] = os.path.join(DATA_DIR, 'maps')
+os.environ['WATCH_MODE'] = 'off'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as team_map_app  # noqa: E402
+
+
+@pytest.fixture(scope='session', autouse=True)
+def data_dir():
+    yield DATA_DIR
+    # Flush snapshots while output is still captured; the exit hook then has nothing to write
+    team_map_app.write_snapshots()
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def no_geocoding(monkeypatch):
+    monkeypatch.setattr(team_map_app, 'get_nearest_city', lambda lat, lon: 'Testville')
+
+
+@pytest.fixture
+def client():
+    return team_map_app.app.test_client()
+
+
+@pytest.fixture
+def map_id():
+    # A fresh map per test keeps pins from leaking between tests
+    return f'test-{uuid.uuid4().hex[:12]}'
+
+
+@pytest.fixture
+def team_map(map_id):
+    team_map = team_map_app.maps.acquire(map_id)
+    yield team_map
+    team_map_app.maps.release(team_map)
+
+
+@pytest.fixture
+def store(team_map):
+    return team_map.store
@@ -0,0 +1,616 @@
+import io
+import json
+import math
+import os
+import queue
+import random
+import threading
+import time
+import zipfile
+
+import pytest
+
+import app
+from app import PinStore, parse_bbox
+
+
+def create_pin(client, map_id, name='Pin', lat=0.0, lng=0.0):
+    response = client.post(f'/maps/{map_id}/pins', json={'name': name, 'lat': lat, 'lng': lng})
+    assert response.get_json()['status'] == 'success'
+    return response.get_json()['pin']
+
+
+def fetch_pages(client, map_id, limit, query='', between_pages=None):
+    ids, cursor, pages = [], None, 0
+    while True:
+        url = f'/maps/{map_id}/pins?limit={limit}{query}' + (f'&cursor={cursor}' if cursor else '')
+        body = client.get(url).get_json()
+        ids.extend(pin['id'] for pin in body['pins'])
+        cursor = body['nextCursor']
+        pages += 1
+        if not cursor:
+            return ids
+        if between_pages:
+            between_pages(pages)
+
+
+def test_pages_cover_every_pin_newest_first(client, map_id):
+    created = [create_pin(client, map_id, f'Pin {i}')['id'] for i in range(12)]
+
+    assert fetch_pages(client, map_id, 5) == created[::-1]
+
+
+def test_pages_stay_stable_across_inserts(client, map_id):
+    created = [create_pin(client, map_id, f'Pin {i}')['id'] for i in range(12)]
+
+    # Pins added mid-walk are newer than the cursor, so they neither shift nor repeat later pages
+    ids = fetch_pages(client, map_id, 5, between_pages=lambda page: create_pin(client, map_id, f'Late {page}'))
+
+    assert ids == created[::-1]
+
+
+def test_page_rejects_bad_limit_and_cursor(client, map_id):
+    assert client.get(f'/maps/{map_id}/pins?limit=0').status_code == 400
+    assert client.get(f'/maps/{map_id}/pins?limit=abc').status_code == 400
+    assert client.get(f'/maps/{map_id}/pins?limit=5&cursor=not-a-cursor').status_code == 400
+
+
+def test_load_skips_unreadable_pin_files(store):
+    newest_first = save_dated_pins(store, 5)
+    with open(os.path.join(store.pins_dir, 'truncated.json'), 'w') as f:
+        f.write('{"name": "Trunc')
+    with open(os.path.join(store.pins_dir, 'not-an-object.json'), 'w') as f:
+        f.write('[1, 2]')
+    with open(os.path.join(store.pins_dir, 'odd-timestamp.json'), 'w') as f:
+        json.dump({'name': 'Odd', 'lat': 1, 'lng': 1, 'timestamp': 12345}, f)
+
+    reloaded = PinStore(store.pins_dir)
+    assert reloaded.count() == 6
+    assert [pin['id'] for pin in reloaded.all()] == newest_first + ['odd-timestamp']
+    assert not [name for name in os.listdir(store.pins_dir) if name.endswith('.tmp')]
+
+
+def search_names(client, map_id, query):
+    body = client.get(f'/maps/{map_id}/pins/search', query_string={'q': query}).get_json()
+    return [pin['name'] for pin in body['pins']]
+
+
+def test_search_matches_prefixes_of_every_query_token(client, map_id):
+    for name in ('Coffee Shop', 'Coffee Roasters', 'Cold Brew Shop'):
+        create_pin(client, map_id, name)
+
+    assert sorted(search_names(client, map_id, 'cof')) == ['Coffee Roasters', 'Coffee Shop']
+    assert sorted(search_names(client, map_id, 'co sh')) == ['Coffee Shop', 'Cold Brew Shop']
+    assert search_names(client, map_id, 'coffee sh') == ['Coffee Shop']
+    assert search_names(client, map_id, 'coffee tea') == []
+
+
+def test_search_ranks_exact_and_name_matches_first(client, map_id):
+    create_pin(client, map_id, 'Parking Lot')
+    create_pin(client, map_id, 'Park')
+    create_pin(client, map_id, 'Harbour')
+    create_pin(client, map_id, 'Testville Tower')
+
+    assert search_names(client, map_id, 'park') == ['Park', 'Parking Lot']
+    # Every pin is geocoded to Testville, but a name match outranks a location match
+    assert search_names(client, map_id, 'testville')[0] == 'Testville Tower'
+
+
+def test_search_index_follows_edits_and_deletes(client, map_id, store):
+    pin = create_pin(client, map_id, 'Old Name')
+    store.save(dict(pin, name='New Name'))
+
+    assert search_names(client, map_id, 'old') == []
+    assert search_names(client, map_id, 'new') == ['New Name']
+
+    client.delete(f'/maps/{map_id}/pins/{pin["id"]}')
+    assert search_names(client, map_id, 'new') == []
+    assert 'new' not in store.by_text.tokens and 'old' not in store.by_text.tokens
+
+
+def test_search_requires_query(client, map_id):
+    assert client.get(f'/maps/{map_id}/pins/search?q=').status_code == 400
+
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    h = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2)
+    return 2 * 6371.0088 * math.asin(min(1.0, math.sqrt(h)))
+
+
+@pytest.fixture
+def scattered_pins(store):
+    # Clusters near the antimeridian and a pole stress the grid's distance lower bound
+    rng = random.Random(31)
+    pins = []
+    for i in range(400):
+        if i % 4 == 0:
+            lat, lng = rng.uniform(-20, 20), rng.choice([rng.uniform(175, 180), rng.uniform(-180, -175)])
+        elif i % 4 == 1:
+            lat, lng = rng.uniform(80, 90), rng.uniform(-180, 180)
+        else:
+            lat, lng = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        pin = {'id': f'pin-{i}', 'name': f'Pin {i}', 'lat': lat, 'lng': lng, 'timestamp': f'2024-01-01T00:00:{i:03d}'}
+        store.save(pin)
+        pins.append(pin)
+    return pins
+
+
+@pytest.mark.parametrize('lat,lng', [(0.0, 179.9), (0.0, -179.9), (89.5, 10.0), (-45.0, 60.0), (48.85, 2.35)])
+def test_nearby_matches_brute_force(client, map_id, scattered_pins, lat, lng):
+    body = client.get(f'/maps/{map_id}/pins/nearby?lat={lat}&lng={lng}&k=15').get_json()
+
+    expected = sorted(scattered_pins, key=lambda pin: haversine_km(lat, lng, pin['lat'], pin['lng']))[:15]
+    assert [pin['id'] for pin in body['pins']] == [pin['id'] for pin in expected]
+    for pin in body['pins']:
+        assert pin['distanceKm'] == pytest.approx(haversine_km(lat, lng, pin['lat'], pin['lng']), abs=0.001)
+
+
+def test_nearby_radius_limits_results(client, map_id, scattered_pins):
+    lat, lng, radius_km = 0.0, 179.0, 1500
+    body = client.get(f'/maps/{map_id}/pins/nearby?lat={lat}&lng={lng}&k=100&radius_km={radius_km}').get_json()
+
+    expected = {pin['id'] for pin in scattered_pins if haversine_km(lat, lng, pin['lat'], pin['lng']) <= radius_km}
+    assert expected and {pin['id'] for pin in body['pins']} == expected
+
+
+@pytest.mark.parametrize('query', ['lng=0', 'lat=0&lng=0&k=0', 'lat=0&lng=0&radius_km=-5', 'lat=0&lng=0&radius_km=nan'])
+def test_nearby_rejects_invalid_parameters(client, map_id, query):
+    assert client.get(f'/maps/{map_id}/pins/nearby?{query}').status_code == 400
+
+
+@pytest.mark.parametrize('lat,lng', [(0, 'inf'), ('nan', 0), (0, '-inf')])
+def test_create_pin_rejects_non_finite_coordinates(client, map_id, store, lat, lng):
+    response = client.post(f'/maps/{map_id}/pins', json={'name': 'Nowhere', 'lat': lat, 'lng': lng})
+
+    assert response.status_code == 400
+    assert store.count() == 0 and search_names(client, map_id, 'nowhere') == []
+
+
+def test_non_finite_pin_file_is_indexed_without_location(client, map_id, store):
+    store.save({'id': 'edge', 'name': 'Edge', 'lat': 0.0, 'lng': float('inf'), 'timestamp': '2024-01-01'})
+
+    reloaded = PinStore(store.pins_dir)
+    assert reloaded.count() == 1
+    assert reloaded.nearby(0.0, 0.0, 5) == []
+    assert search_names(client, map_id, 'edge') == ['Edge']
+
+
+
+@pytest.mark.parametrize('bbox,boxes', [
+    ('-10,-5,10,5', [(-5.0, -10.0, 5.0, 10.0)]),
+    ('170,-5,190,5', [(-5.0, 170.0, 5.0, 180.0), (-5.0, -180.0, 5.0, -170.0)]),
+    ('170,-5,-170,5', [(-5.0, 170.0, 5.0, 180.0), (-5.0, -180.0, 5.0, -170.0)]),
+    ('-200,-100,200,100', [(-90.0, -180.0, 90.0, 180.0)]),
+    ('0,-10,180,10', [(-10.0, 0.0, 10.0, 180.0)]),
+    ('-180,-10,0,10', [(-10.0, -180.0, 10.0, 0.0)]),
+    ('180,-10,190,10', [(-10.0, -180.0, 10.0, -170.0)]),
+    ('170,-10,180,10', [(-10.0, 170.0, 10.0, 180.0)]),
+])
+def test_parse_bbox_normalizes_and_splits_at_antimeridian(bbox, boxes):
+    assert parse_bbox(bbox) == boxes
+
+
+@pytest.mark.parametrize('bbox', ['1,2,3', '0,10,10,0', '0,0,nan,10', 'a,b,c,d'])
+def test_parse_bbox_rejects_invalid_boxes(bbox):
+    with pytest.raises(ValueError):
+        parse_bbox(bbox)
+
+
+def test_heatmap_counts_pins_on_both_sides_of_antimeridian(client, map_id):
+    for lat, lng in [(1.0, 179.5), (2.0, 179.6), (-1.0, -179.5), (0.0, 0.0), (30.0, 179.5)]:
+        create_pin(client, map_id, lat=lat, lng=lng)
+
+    body = client.get(f'/maps/{map_id}/heatmap?zoom=3&bbox=170,-10,-170,10').get_json()
+
+    assert sum(cell['count'] for cell in body['cells']) == 3
+    for cell in body['cells']:
+        assert cell['east'] - cell['west'] == pytest.approx(body['cellSize'])
+        assert cell['west'] >= 170 or cell['east'] <= -170
+
+
+def test_heatmap_box_ending_at_antimeridian_excludes_far_side(client, map_id):
+    create_pin(client, map_id, lat=0.0, lng=-179.9)
+    create_pin(client, map_id, lat=0.0, lng=90.0)
+
+    body = client.get(f'/maps/{map_id}/heatmap?zoom=3&bbox=0,-10,180,10').get_json()
+
+    assert sum(cell['count'] for cell in body['cells']) == 1
+
+
+def test_heatmap_rejects_bad_parameters(client, map_id):
+    assert client.get(f'/maps/{map_id}/heatmap?zoom=x').status_code == 400
+    assert client.get(f'/maps/{map_id}/heatmap?bbox=1,2,3').status_code == 400
+
+
+
+def save_dated_pins(store, count, prefix='old'):
+    pins = [{'id': f'{prefix}-{i:02d}', 'name': f'{prefix} {i}', 'lat': 1.0, 'lng': 1.0,
+             'timestamp': f'2020-01-01T00:00:{i:02d}'} for i in range(count)]
+    for pin in pins:
+        store.save(pin)
+    return [pin['id'] for pin in reversed(pins)]
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(app, 'ARCHIVE_SEGMENT_SIZE', 4)
+
+
+def test_archive_round_trip(client, map_id, store, small_segments):
+    newest_first = save_dated_pins(store, 20)
+
+    assert store.archive_old(keep_newest=8) == 12
+    assert len(store.archive.segments) == 3
+
+    hot = client.get(f'/maps/{map_id}/pins').get_json()['pins']
+    assert [pin['id'] for pin in hot] == newest_first[:8]
+    full = client.get(f'/maps/{map_id}/pins?include_archived=1').get_json()['pins']
+    assert [pin['id'] for pin in full] == newest_first
+
+    body = client.get(f'/maps/{map_id}/pins/old-00').get_json()
+    assert body['archived'] is True and body['pin']['name'] == 'old 0'
+    assert client.get(f'/maps/{map_id}/pins/old-19').get_json()['archived'] is False
+
+    # A fresh store reads both tiers back from disk
+    reloaded = PinStore(store.pins_dir)
+    assert reloaded.count() == 8 and reloaded.archive.count() == 12
+    assert [pin['id'] for pin in reloaded.all(include_archived=True)] == newest_first
+
+
+def test_archived_paging_merges_tiers_and_stays_stable(client, map_id, store, small_segments):
+    newest_first = save_dated_pins(store, 20)
+    store.archive_old(keep_newest=7)
+
+    assert fetch_pages(client, map_id, 3, '&include_archived=1') == newest_first
+    ids = fetch_pages(client, map_id, 3, '&include_archived=1',
+                      between_pages=lambda page: create_pin(client, map_id, f'Late {page}'))
+    assert ids == newest_first
+
+
+def test_deleting_archived_pin_leaves_tombstone(client, map_id, store):
+    newest_first = save_dated_pins(store, 6)
+    store.archive_old(keep_newest=2)
+
+    assert client.delete(f'/maps/{map_id}/pins/old-01').status_code == 200
+    assert client.get(f'/maps/{map_id}/pins/old-01').status_code == 404
+    assert client.delete(f'/maps/{map_id}/pins/old-01').status_code == 404
+
+    full = client.get(f'/maps/{map_id}/pins?include_archived=1').get_json()['pins']
+    assert [pin['id'] for pin in full] == [pin_id for pin_id in newest_first if pin_id != 'old-01']
+    reloaded = PinStore(store.pins_dir)
+    reloaded.load()
+    assert 'old-01' in reloaded.archive.deleted and 'old-01' not in reloaded.archive.locations
+
+
+def test_archive_is_shared_between_processes(store):
+    save_dated_pins(store, 6)
+    other = PinStore(store.pins_dir)
+    other.load()
+
+    assert store.archive_old(keep_newest=4) == 2
+    # The second store still holds old-00/old-01 as hot, but must not re-archive or drop them
+    assert other.archive_old(keep_newest=2) == 2
+    assert other.sync_files(['old-00', 'old-01']) == []
+
+    reloaded = PinStore(store.pins_dir)
+    reloaded.load()
+    assert sorted(reloaded.archive.locations) == ['old-00', 'old-01', 'old-02', 'old-03']
+    assert reloaded.count() == 2
+
+
+def test_delete_of_pin_archived_by_another_process(client, map_id, store):
+    save_dated_pins(store, 4)
+    store.load()
+    other = PinStore(store.pins_dir)
+    assert other.archive_old(keep_newest=2) == 2
+
+    # This store still has old-00 hot, but its file is gone and it lives in the archive now
+    assert client.delete(f'/maps/{map_id}/pins/old-00').status_code == 200
+    assert client.get(f'/maps/{map_id}/pins/old-00').status_code == 404
+    reloaded = PinStore(store.pins_dir)
+    reloaded.load()
+    assert 'old-00' in reloaded.archive.deleted and sorted(reloaded.archive.locations) == ['old-01']
+
+
+def test_export_and_connections_account_for_archive(client, map_id, store):
+    save_dated_pins(store, 4)
+    old, new = store.get('old-00'), store.get('old-03')
+    connection = {'id': 'c1', 'sourceId': 'old-00', 'targetId': 'old-03'}
+    store.save(dict(old, connections=[connection]))
+    store.save(dict(new, connections=[connection]))
+    assert [c['id'] for c in client.get(f'/maps/{map_id}/connections').get_json()['connections']] == ['c1']
+
+    store.archive_old(keep_newest=2)
+
+    assert client.get(f'/maps/{map_id}/connections').get_json()['connections'] == []
+    names = zipfile.ZipFile(io.BytesIO(client.get(f'/maps/{map_id}/download-pins').data)).namelist()
+    assert 'archive/index.json' in names
+    assert sum(name.startswith('archive/segment-') for name in names) == 1
+    assert sorted(name for name in names if not name.startswith('archive/')) == ['old-02.json', 'old-03.json']
+
+
+@pytest.fixture
+def geocoder(monkeypatch):
+    # Records lookups; answers come from `responses` by rounded latitude, else a default name
+    class Geocoder:
+        def __init__(self):
+            self.calls = []
+            self.responses = {}
+            self.before_answer = None
+
+        def __call__(self, lat, lon):
+            self.calls.append((lat, lon))
+            if self.before_answer:
+                self.before_answer(lat, lon)
+            return self.responses.get(round(lat), f'City {round(lat)}')
+
+    stub = Geocoder()
+    monkeypatch.setattr(app, 'get_nearest_city', stub)
+    return stub
+
+
+def save_unlocated_pins(store):
+    # Three pins share one level-12 cell, one sits far away, one already has a location
+    pins = [
+        {'id': 'a1', 'lat': 10.001, 'lng': 10.001},
+        {'id': 'a2', 'lat': 10.002, 'lng': 10.003, 'location': 'Unknown location'},
+        {'id': 'a3', 'lat': 10.003, 'lng': 10.002, 'location': ''},
+        {'id': 'b1', 'lat': 40.0, 'lng': -70.0},
+        {'id': 'c1', 'lat': 10.001, 'lng': 10.001, 'location': 'Already Here'},
+    ]
+    for pin in pins:
+        store.save(dict(pin, name=pin['id'], timestamp='2024-01-01T00:00:00'))
+    assert len({app.LocationBackfill.cell_key(pin) for pin in pins[:3]}) == 1
+
+
+def locations(store):
+    return {pin['id']: pin.get('location') for pin in store.all()}
+
+
+def test_backfill_looks_up_each_cell_once(team_map, store, geocoder):
+    save_unlocated_pins(store)
+    events = queue.Queue()
+    team_map.broadcaster.register(events, 'test-client')
+
+    job = app.LocationBackfill(team_map, batch_size=2)
+    job.run()
+
+    assert len(geocoder.calls) == 2
+    assert locations(store) == {'a1': 'City 10', 'a2': 'City 10', 'a3': 'City 10', 'b1': 'City 40', 'c1': 'Already Here'}
+    status = job.status()
+    assert status['state'] == 'finished' and status['pinsUpdated'] == 4 and status['cellsTotal'] == 2
+    updates = [json.loads(events.get_nowait()) for _ in range(events.qsize())]
+    assert sorted(event['pin']['id'] for event in updates if event['type'] == 'pin_updated') == ['a1', 'a2', 'a3', 'b1']
+    assert not os.path.exists(os.path.join(store.pins_dir, app.BACKFILL_PROGRESS_FILENAME))
+
+
+def test_backfill_leaves_unresolved_cells_alone(team_map, store, geocoder):
+    save_unlocated_pins(store)
+    geocoder.responses[40] = app.UNKNOWN_LOCATION
+
+    job = app.LocationBackfill(team_map)
+    job.run()
+
+    assert locations(store)['b1'] is None
+    assert locations(store)['a1'] == 'City 10'
+    assert job.status()['cellsFailed'] == 1
+
+
+def test_backfill_resumes_from_progress_file(team_map, store, geocoder):
+    save_unlocated_pins(store)
+    cell = app.LocationBackfill.cell_key({'lat': 10.001, 'lng': 10.001})
+    with open(os.path.join(store.pins_dir, app.BACKFILL_PROGRESS_FILENAME), 'w') as f:
+        json.dump({cell: 'From Last Run'}, f)
+
+    job = app.LocationBackfill(team_map)
+    job.run()
+
+    assert [round(lat) for lat, _ in geocoder.calls] == [40]
+    assert locations(store)['a2'] == 'From Last Run'
+    assert job.status()['cellsResumed'] == 1
+
+
+def test_backfill_keeps_edits_made_during_run(team_map, store, geocoder):
+    save_unlocated_pins(store)
+
+    def edit_meanwhile(lat, lon):
+        if round(lat) == 10:
+            store.save(dict(store.get('a2'), location='Set By Hand'))
+    geocoder.before_answer = edit_meanwhile
+
+    app.LocationBackfill(team_map).run()
+
+    assert locations(store)['a2'] == 'Set By Hand'
+    assert locations(store)['a1'] == 'City 10'
+
+
+def test_backfill_admin_endpoint(client, map_id, store, geocoder, monkeypatch):
+    save_unlocated_pins(store)
+    url = f'/maps/{map_id}/admin/backfill-locations'
+
+    monkeypatch.setattr(app, 'ADMIN_TOKEN', None)
+    assert client.post(url).status_code == 403
+
+    monkeypatch.setattr(app, 'ADMIN_TOKEN', 'secret')
+    auth = {'Authorization': 'Bearer secret'}
+    assert client.post(url).status_code == 401
+    assert client.post(url, headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    assert client.get(url, headers=auth).status_code == 404
+
+    release = threading.Event()
+    geocoder.before_answer = lambda lat, lon: release.wait(5)
+    assert client.post(url, headers=auth).status_code == 202
+    assert client.post(url, headers=auth).status_code == 409
+    release.set()
+
+    deadline = time.monotonic() + 5
+    while client.get(url, headers=auth).get_json()['backfill']['state'] == 'running' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    status = client.get(url, headers=auth).get_json()['backfill']
+    assert status['state'] == 'finished' and status['pinsUpdated'] == 4
+
+
+def test_backfill_cli_command(map_id, store, geocoder):
+    save_unlocated_pins(store)
+    runner = app.app.test_cli_runner()
+
+    result = runner.invoke(args=['backfill-locations', '--map', map_id])
+    assert result.exit_code == 0, result.output
+    assert 'Done: 4 pins updated' in result.output
+    assert runner.invoke(args=['backfill-locations', '--map', 'bad/id']).exit_code == 2
+
+
+def write_external(store, pin_id, **fields):
+    with open(store.path(pin_id), 'w') as f:
+        json.dump(dict({'name': pin_id, 'lat': 1.0, 'lng': 1.0, 'timestamp': '2024-01-01T00:00:00'}, **fields), f)
+
+
+def test_sync_applies_external_add_edit_and_remove(team_map, store):
+    store.save({'id': 'kept', 'name': 'Kept', 'lat': 0.0, 'lng': 0.0, 'timestamp': '2024-01-01T00:00:00'})
+    events = queue.Queue()
+    team_map.broadcaster.register(events, 'test-client')
+
+    write_external(store, 'outside')
+    assert store.changed_files() == ['outside']
+    app.watcher._apply(team_map, store.changed_files())
+    assert store.get('outside')['name'] == 'outside'
+
+    write_external(store, 'outside', name='Renamed outside the app')
+    app.watcher._apply(team_map, store.changed_files())
+    assert store.get('outside')['name'] == 'Renamed outside the app'
+
+    os.remove(store.path('outside'))
+    app.watcher._apply(team_map, store.changed_files())
+    assert store.get('outside') is None
+
+    messages = [json.loads(events.get_nowait()) for _ in range(events.qsize())]
+    assert [(message['type'], message['pin']['id']) for message in messages] == [
+        ('pin_added', 'outside'), ('pin_updated', 'outside'), ('pin_deleted', 'outside')]
+    assert [pin['id'] for pin in store.all()] == ['kept']
+
+
+def test_sync_skips_own_writes(store):
+    store.save({'id': 'mine', 'name': 'Mine', 'lat': 0.0, 'lng': 0.0, 'timestamp': '2024-01-01T00:00:00'})
+    store.save(dict(store.get('mine'), name='Mine again'))
+
+    assert store.changed_files() == []
+    assert store.sync_files(['mine']) == []
+
+
+def test_sync_retries_half_written_files(store):
+    store.load()
+    os.makedirs(store.pins_dir)
+    with open(store.path('partial'), 'w') as f:
+        f.write('{"name": "Parti')
+
+    assert store.sync_files(store.changed_files()) == []
+    assert store.get('partial') is None
+
+    write_external(store, 'partial', name='Partial')
+    assert store.changed_files() == ['partial']
+    assert [(event, pin['name']) for event, pin in store.sync_files(['partial'])] == [('pin_added', 'Partial')]
+
+
+@pytest.fixture
+def file_reads(monkeypatch):
+    reads = []
+    read_pin_file = app.read_pin_file
+
+    def counting_read(path):
+        reads.append(os.path.basename(path))
+        return read_pin_file(path)
+    monkeypatch.setattr(app, 'read_pin_file', counting_read)
+    return reads
+
+
+def test_snapshot_reload_replays_only_changed_files(store, file_reads):
+    save_dated_pins(store, 5)
+    assert store.write_snapshot()
+    write_external(store, 'old-01', name='Edited after snapshot', timestamp='2020-01-01T00:00:01')
+    write_external(store, 'added', timestamp='2020-01-01T00:00:09')
+    os.remove(store.path('old-03'))
+
+    reloaded = PinStore(store.pins_dir)
+    reloaded.load()
+
+    assert sorted(file_reads) == ['added.json', 'old-01.json']
+    assert [pin['id'] for pin in reloaded.all()] == ['added', 'old-04', 'old-02', 'old-01', 'old-00']
+    assert reloaded.get('old-01')['name'] == 'Edited after snapshot'
+
+
+def test_snapshot_with_other_format_version_is_ignored(store, file_reads):
+    newest_first = save_dated_pins(store, 5)
+    store.write_snapshot()
+    snapshot_path = os.path.join(store.pins_dir, app.SNAPSHOT_FILENAME)
+    with open(snapshot_path) as f:
+        snapshot = json.load(f)
+    snapshot['formatVersion'] = app.SNAPSHOT_FORMAT_VERSION + 1
+    snapshot['pins']['old-00']['name'] = 'Stale'
+    with open(snapshot_path, 'w') as f:
+        json.dump(snapshot, f)
+
+    reloaded = PinStore(store.pins_dir)
+    reloaded.load()
+
+    assert len(file_reads) == 5
+    assert [pin['id'] for pin in reloaded.all()] == newest_first
+    assert reloaded.get('old-00')['name'] == 'old 0'
+
+
+def test_health_reports_ready_after_warm_up(client, monkeypatch):
+    monkeypatch.setitem(app.startup, 'ready_seconds', None)
+    assert client.get('/health').status_code == 503
+
+    app.warm_up()
+
+    response = client.get('/health')
+    assert response.status_code == 200 and response.get_json()['status'] == 'ok'
+
+
+@pytest.mark.parametrize('bad_id', ['abc%0A', 'a.b', 'x' * 65])
+def test_invalid_map_ids_are_rejected(client, bad_id):
+    response = client.post(f'/maps/{bad_id}/pins', json={'name': 'Pin', 'lat': 0, 'lng': 0})
+
+    assert response.status_code == 404
+    assert not os.path.exists(os.path.join(app.MAPS_DIR, 'abc\n'))
+
+
+def test_cli_rejects_map_id_with_trailing_newline():
+    assert app.app.test_cli_runner().invoke(args=['backfill-locations', '--map', 'abc\n']).exit_code == 2
+
+
+def test_maps_keep_pins_search_and_streams_separate(client):
+    first, second = 'iso-first', 'iso-second'
+    streams = {}
+    for map_id in (first, second):
+        team_map = app.maps.acquire(map_id)
+        streams[map_id] = queue.Queue()
+        team_map.broadcaster.register(streams[map_id], f'{map_id}-client')
+        app.maps.release(team_map)
+
+    create_pin(client, first, 'Lighthouse')
+
+    assert [pin['name'] for pin in client.get(f'/maps/{first}/pins').get_json()['pins']] == ['Lighthouse']
+    assert client.get(f'/maps/{second}/pins').get_json()['pins'] == []
+    assert search_names(client, second, 'light') == []
+    assert json.loads(streams[first].get_nowait())['type'] == 'pin_added'
+    assert streams[second].empty()
+
+
+def test_idle_maps_are_evicted_and_reload_from_disk(client, monkeypatch):
+    create_pin(client, 'evict-idle', 'Survivor')
+    subscribed = app.maps.acquire('evict-busy')
+    subscribed.broadcaster.register(queue.Queue(), 'busy-client')
+    app.maps.release(subscribed)
+
+    monkeypatch.setattr(app, 'MAP_IDLE_SECONDS', 0)
+    monkeypatch.setattr(app.maps, 'last_sweep', time.monotonic() - 61)
+    time.sleep(0.01)
+    client.get('/maps/evict-trigger/pins')
+
+    assert 'evict-idle' not in app.maps.maps and 'evict-idle' not in app.watcher.maps
+    assert 'evict-busy' in app.maps.maps and app.DEFAULT_MAP_ID in app.maps.maps
+    assert [pin['name'] for pin in client.get('/maps/evict-idle/pins').get_json()['pins']] == ['Survivor']